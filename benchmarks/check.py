@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+# Copyright 2013 anthony cantor
+# This file is part of sefi.
+#
+# sefi is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# sefi is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with sefi.  If not, see <http://www.gnu.org/licenses/>.
+'''
+regression checks for the decode cache. each case is searched
+with every available disassembler backend, once with the cache
+turned off and once with it on, and the gadgets found have to
+be the same. exits with status 1 if any case differs.
+'''
+import os.path
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import sefi
+import sefi.arch
+import sefi.matcher
+import sefi.container
+import sefi.disassembler
+
+#(name, arch, segment bytes, backward search length)
+CASES = [
+	#9b alone is WAIT, but distorm decodes 9b db e3 as FINIT. a
+	#cached WAIT must not be handed out for the second 9b.
+	("wait", sefi.arch.x86_64, "\x9b\x90\xc3" + "\xcc"*40 + "\x9b\xdb\xe3\xc3", 5),
+	("wait-x86", sefi.arch.x86, "\x9b\x90\xc3" + "\xcc"*40 + "\x9b\xd9\x30\xc3", 5)
+]
+
+def search(arch, data, n, cache_size):
+	sefi.disassembler.decode_cache = sefi.disassembler.DecodeCache(cache_size)
+	backward_search = lambda seq, matcher, seg, offset, table: \
+		sefi.backward_search_n(seq, matcher, seg, offset, n, table)
+
+	return [
+		(gadget.addr(), gadget.str_seq()) for (gadget, ms) in \
+			sefi.search_data_multi(
+				[sefi.container.Segment(data, 0x1000)],
+				[sefi.matcher.Rets()],
+				arch,
+				backward_search
+			)
+	]
+
+def main():
+	failed = 0
+	default_size = sefi.disassembler.decode_cache.size
+
+	for (name, arch, data, n) in CASES:
+		for backend in sefi.disassembler.backend_names():
+			if sefi.disassembler.try_backend(backend, arch) is None:
+				continue
+
+			rank = sefi.disassembler.rankings[backend]
+			sefi.disassembler.backend_set_rank(backend, 9999)
+			expect = search(arch, data, n, 0)
+			got = search(arch, data, n, default_size)
+			sefi.disassembler.backend_set_rank(backend, rank)
+
+			if got == expect:
+				print("ok      %s/%s" % (name, backend))
+			else:
+				failed += 1
+				print("FAILED  %s/%s:\n  uncached: %r\n  cached:   %r" % (
+					name, backend, expect, got
+				))
+
+	if failed > 0:
+		exit(1)
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,297 @@
+#!/usr/bin/env python
+# Copyright 2013 anthony cantor
+# This file is part of sefi.
+# 
+# sefi is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#  
+# sefi is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#  
+# You should have received a copy of the GNU General Public License
+# along with sefi.  If not, see <http://www.gnu.org/licenses/>.
+'''
+end to end benchmarks for gadget search. synthetic ELF files
+are generated for every combination of arch, size and terminator
+density, then searched with every matcher (and all of them at
+once), -n value, number of worker processes, way of consuming the
+gadgets (see MODES) and available disassembler backend. each search
+runs in its own process so its peak RSS can be measured. results are printed and written as json
+so that runs can be compared with --compare.
+'''
+import argparse
+import itertools
+import json
+import multiprocessing
+import os
+import os.path
+import resource
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import sefi
+import sefi.arch
+import sefi.matcher
+import sefi.disassembler
+import sefi.container
+from sefi import elf
+
+import synth_elf
+
+#functions returning the matchers each case searches for at once
+MATCHERS = {
+	"ret":		lambda: [sefi.matcher.Rets()],
+	"jmp-reg":	lambda: [sefi.matcher.JmpRegUncond()],
+	"call-reg":	lambda: [sefi.matcher.CallReg()],
+	"all":		lambda: [
+		sefi.matcher.Rets(),
+		sefi.matcher.JmpRegUncond(),
+		sefi.matcher.CallReg()
+	],
+	#a matcher without a signature, so every offset is decoded
+	"regexp":	lambda: [sefi.matcher.REMatcher("^(?:ret|pop|bx)")]
+}
+
+#how the gadgets of a case are consumed:
+#plain: iterate over the (gadget, matchers) tuples, like the cli does
+#unique: group them in a UniqueGadgetIndex, like --unique does
+#stream: serialize the json records, like --stream does
+MODES = ["plain", "unique", "stream"]
+
+def opt_parser():
+	parser = argparse.ArgumentParser(description='benchmark sefi gadget searches')
+
+	def int_list(s):
+		return [int(x, 0) for x in s.split(",")]
+
+	def str_list(s):
+		return s.split(",")
+
+	parser.add_argument(
+		'--arches',
+		type=str_list,
+		help='comma separated list of arches. default: %(default)s',
+		default=["x86-64", "x86", "arm"]
+	)
+
+	parser.add_argument(
+		'--sizes',
+		type=int_list,
+		help='comma separated list of segment sizes in bytes. default: %(default)s',
+		default=[0x4000, 0x10000]
+	)
+
+	parser.add_argument(
+		'--densities',
+		type=int_list,
+		help='comma separated list of terminators per KB. default: %(default)s',
+		default=[2, 16]
+	)
+
+	parser.add_argument(
+		'-n',
+		type=int_list,
+		help='comma separated list of backward search lengths. default: %(default)s',
+		default=[10, 20]
+	)
+
+	parser.add_argument(
+		'--matchers',
+		type=str_list,
+		help='comma separated list of matchers (%s). default: all' % (
+			", ".join(sorted(MATCHERS.keys()))
+		),
+		default=sorted(MATCHERS.keys())
+	)
+
+	parser.add_argument(
+		'-j',
+		'--jobs',
+		type=int_list,
+		help='comma separated list of worker process counts. default: %(default)s',
+		default=[1, 2]
+	)
+
+	parser.add_argument(
+		'--modes',
+		type=str_list,
+		help='comma separated list of ways to consume the gadgets ' + \
+				'(%s). default: all' % (", ".join(MODES)),
+		default=MODES
+	)
+
+	parser.add_argument(
+		'--backends',
+		type=str_list,
+		help='comma separated list of disassembler backends. default: all',
+		default=sefi.disassembler.backend_names()
+	)
+
+	parser.add_argument(
+		'-o',
+		'--output',
+		metavar='FILE',
+		help='write the results to FILE. default: results/<time>.json ' + \
+				'next to this script'
+	)
+
+	parser.add_argument(
+		'--compare',
+		metavar='FILE',
+		help='compare the results against an earlier run stored in FILE'
+	)
+
+	return parser
+
+def peak_rss(who=resource.RUSAGE_SELF):
+	'''
+	peak resident set size of this process in KB, or with
+	resource.RUSAGE_CHILDREN, of the largest of its finished
+	child processes (the workers of a parallel search).
+	'''
+	return resource.getrusage(who).ru_maxrss
+
+def run_case(path, backend, matcher, n, jobs, mode, queue):
+	sefi.disassembler.backend_set_rank(backend, 9999)
+	cache = sefi.disassembler.decode_cache
+	cache.clear()
+
+	with open(path, "rb") as f:
+		elf_o, _ = elf.open(f)
+		size = sum([len(seg.data) for seg in elf.executable_data(elf_o)])
+		matchers = MATCHERS[matcher]()
+
+		start = time.time()
+		gadgets = 0
+		if mode == "stream":
+			for record in sefi.search_elf_for_gadget_records(f, n, matchers, jobs):
+				json.dumps(record, sort_keys=True)
+				gadgets += 1
+		else:
+			index = sefi.container.UniqueGadgetIndex()
+			for (gadget, ms) in sefi.search_elf_for_gadgets_multi(f, n, matchers, jobs):
+				if mode == "unique":
+					index.add(gadget, ms)
+				gadgets += 1
+		wall = time.time() - start
+
+	#every offset the search needed an instruction for goes
+	#through the decode cache, whether it was decoded or not
+	decoded = cache.hits + cache.misses
+	queue.put({
+		"bytes": size,
+		"offsets": decoded,
+		"gadgets": gadgets,
+		"wall": wall,
+		"offsets_per_sec": decoded / wall if wall > 0 else None,
+		"gadgets_per_sec": gadgets / wall if wall > 0 else None,
+		"peak_rss_kb": peak_rss(),
+		"workers_peak_rss_kb": peak_rss(resource.RUSAGE_CHILDREN)
+	})
+
+def measure(path, backend, matcher, n, jobs, mode):
+	queue = multiprocessing.Queue()
+	proc = multiprocessing.Process(
+		target=run_case,
+		args=(path, backend, matcher, n, jobs, mode, queue)
+	)
+	proc.start()
+	result = queue.get()
+	proc.join()
+
+	return result
+
+def case_key(case):
+	#results from before jobs and modes were measured
+	#were all serial, plain searches
+	return "%s/%s/size=%d/density=%d/%s/n=%d/j=%d/%s" % (
+		case["arch"], case["backend"], case["size"],
+		case["density"], case["matcher"], case["n"],
+		case.get("jobs", 1), case.get("mode", "plain")
+	)
+
+def run(options):
+	results = []
+	tmpdir = tempfile.mkdtemp(prefix="sefi-bench-")
+
+	for arch in options.arches:
+		for size in options.sizes:
+			for density in options.densities:
+				path = os.path.join(tmpdir, "%s-%d-%d" % (arch, size, density))
+				synth_elf.write(path, arch, size, density)
+
+				for backend in options.backends:
+					if sefi.disassembler.try_backend(backend, arch) is None:
+						continue
+
+					for (matcher, n, jobs, mode) in itertools.product(
+								options.matchers, options.n,
+								options.jobs, options.modes):
+						case = {
+							"arch": arch,
+							"size": size,
+							"density": density,
+							"backend": backend,
+							"matcher": matcher,
+							"n": n,
+							"jobs": jobs,
+							"mode": mode
+						}
+						case.update(measure(path, backend, matcher, n, jobs, mode))
+						results.append(case)
+						print("%-64s %8.3fs %10.0f offsets/s %8.0f gadgets/s %8d KB %8d KB workers" % (
+							case_key(case), case["wall"],
+							case["offsets_per_sec"] or 0,
+							case["gadgets_per_sec"] or 0,
+							case["peak_rss_kb"],
+							case["workers_peak_rss_kb"]
+						))
+						sys.stdout.flush()
+
+				os.unlink(path)
+
+	os.rmdir(tmpdir)
+	return results
+
+def compare(results, path):
+	with open(path, "r") as f:
+		old = dict([(case_key(c), c) for c in json.load(f)["results"]])
+
+	print("\ncompared to %s (old/new wall time):" % path)
+	for case in results:
+		key = case_key(case)
+		if key not in old or case["wall"] <= 0:
+			continue
+		print("%-64s %6.2fx" % (key, old[key]["wall"] / case["wall"]))
+
+def main():
+	options = opt_parser().parse_args()
+	results = run(options)
+
+	output = options.output
+	if output is None:
+		dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "results")
+		if not os.path.isdir(dir):
+			os.makedirs(dir)
+		output = os.path.join(dir, time.strftime("%Y%m%d-%H%M%S.json"))
+
+	with open(output, "w") as f:
+		json.dump({
+			"time": time.time(),
+			"python": sys.version,
+			"results": results
+		}, f, indent=2, sort_keys=True)
+	print("\nwrote results to %s" % output)
+
+	if options.compare:
+		compare(results, options.compare)
+
+if __name__ == "__main__":
+	main()
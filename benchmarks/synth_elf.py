@@ -0,0 +1,204 @@
+# Copyright 2013 anthony cantor
+# This file is part of sefi.
+# 
+# sefi is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#  
+# sefi is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#  
+# You should have received a copy of the GNU General Public License
+# along with sefi.  If not, see <http://www.gnu.org/licenses/>.
+'''
+generates synthetic ELF executables with a single executable
+segment of a given size and density of gadget terminators, so
+that searches can be benchmarked without depending on the
+binaries installed on the system.
+'''
+import struct
+import random
+
+ELFCLASS32 = 1
+ELFCLASS64 = 2
+EM_386 = 3
+EM_ARM = 40
+EM_X86_64 = 62
+
+PT_LOAD = 1
+PF_X = 1
+PF_R = 4
+SHT_PROGBITS = 1
+SHT_STRTAB = 3
+SHF_ALLOC = 2
+SHF_EXECINSTR = 4
+
+CODE_OFFSET = 0x1000
+
+#(elf class, machine, base address)
+ARCHES = {
+	"x86-64":	(ELFCLASS64, EM_X86_64, 0x400000),
+	"x86":		(ELFCLASS32, EM_386, 0x8048000),
+	"arm":		(ELFCLASS32, EM_ARM, 0x8000)
+}
+
+def words(*ws):
+	return [struct.pack("<I", w) for w in ws]
+
+#filler instructions. "%r" is replaced with random bytes.
+FILLER = {
+	"x86": [
+		"\x31\xc0",					#xor eax, eax
+		"\x89\xd8",					#mov eax, ebx
+		"\x83\xc4\x08",				#add esp, 0x8
+		"\x5b", "\x5d", "\x5e", "\x5f",	#pop reg
+		"\x53", "\x55",				#push reg
+		"\x85\xc0",					#test eax, eax
+		"\x74%r",					#jz rel8
+		"\xe8%r%r%r%r",				#call rel32
+		"\x8b\x45%r",				#mov eax, [ebp+disp8]
+		"\x90",						#nop
+		"\x00\x00"					#add [eax], al
+	],
+	"x86-64": [
+		"\x31\xc0",					#xor eax, eax
+		"\x48\x89\xdf",				#mov rdi, rbx
+		"\x48\x83\xc4\x08",			#add rsp, 0x8
+		"\x5b", "\x5d", "\x41\x5c",	#pop reg
+		"\x53", "\x55",				#push reg
+		"\x48\x85\xc0",				#test rax, rax
+		"\x74%r",					#jz rel8
+		"\xe8%r%r%r%r",				#call rel32
+		"\x48\x8b\x45%r",			#mov rax, [rbp+disp8]
+		"\x66\x90",					#nop
+		"\x00\x00"					#add [rax], al
+	],
+	"arm": words(
+		0xe1a00001,	#mov r0, r1
+		0xe2800001,	#add r0, r0, #1
+		0xe5900000,	#ldr r0, [r0]
+		0xe5810000,	#str r0, [r1]
+		0xe3500000,	#cmp r0, #0
+		0xe92d4010,	#push {r4, lr}
+		0xe1a0f00e	#mov pc, lr
+	)
+}
+
+TERMINATORS = {
+	"x86": [
+		"\xc3",				#ret
+		"\xc2\x08\x00",		#ret 0x8
+		"\xff\xe0",			#jmp eax
+		"\xff\xd0"			#call eax
+	],
+	"x86-64": [
+		"\xc3",				#ret
+		"\xc2\x08\x00",		#ret 0x8
+		"\xff\xe0",			#jmp rax
+		"\x41\xff\xe4",		#jmp r12
+		"\xff\xd0"			#call rax
+	],
+	"arm": words(
+		0xe8bd8010,	#pop {r4, pc}
+		0xe12fff1e,	#bx lr
+		0xe12fff33	#blx r3
+	)
+}
+
+def expand(template, rng):
+	result = ""
+	pieces = template.split("%r")
+	for (i, piece) in enumerate(pieces):
+		result += piece
+		if i < len(pieces) - 1:
+			result += chr(rng.randrange(0, 256))
+
+	return result
+
+def code(arch, size, density, seed=0):
+	'''
+	returns @size bytes of code for @arch in which on average
+	@density out of every 1024 bytes start a gadget terminator.
+	'''
+	rng = random.Random(seed)
+	filler = FILLER[arch]
+	terms = TERMINATORS[arch]
+
+	avg_len = float(sum(map(len, filler))) / len(filler)
+	p_term = min(1.0, density * avg_len / 1024.0)
+
+	result = []
+	total = 0
+	while total < size:
+		if rng.random() < p_term:
+			piece = rng.choice(terms)
+		else:
+			piece = expand(rng.choice(filler), rng)
+		result.append(piece)
+		total += len(piece)
+
+	return "".join(result)[:size]
+
+def elf(arch, size, density, seed=0):
+	'''
+	returns the bytes of an ELF executable for @arch with one
+	executable segment of @size bytes of code.
+	'''
+	(cls, machine, base) = ARCHES[arch]
+	text = code(arch, size, density, seed)
+	shstrtab = "\0.text\0.shstrtab\0"
+
+	if cls == ELFCLASS64:
+		ehsize, phentsize, shentsize = 64, 56, 64
+		addr_fmt = "Q"
+	else:
+		ehsize, phentsize, shentsize = 52, 32, 40
+		addr_fmt = "I"
+
+	shstrtab_off = CODE_OFFSET + len(text)
+	shoff = shstrtab_off + len(shstrtab)
+	shoff += (8 - shoff % 8) % 8
+	vaddr = base + CODE_OFFSET
+
+	ident = "\x7fELF" + struct.pack("BBBB", cls, 1, 1, 0) + "\0"*8
+	ehdr = ident + struct.pack(
+		"<HHI%s%s%sIHHHHHH" % (addr_fmt, addr_fmt, addr_fmt),
+		2, machine, 1, vaddr, ehsize, shoff,
+		0, ehsize, phentsize, 1, shentsize, 3, 2
+	)
+
+	if cls == ELFCLASS64:
+		phdr = struct.pack(
+			"<IIQQQQQQ",
+			PT_LOAD, PF_R | PF_X, CODE_OFFSET,
+			vaddr, vaddr, len(text), len(text), 0x1000
+		)
+	else:
+		phdr = struct.pack(
+			"<IIIIIIII",
+			PT_LOAD, CODE_OFFSET, vaddr, vaddr,
+			len(text), len(text), PF_R | PF_X, 0x1000
+		)
+
+	def shdr(name, type, flags, addr, offset, size):
+		return struct.pack(
+			"<II%s%s%s%sII%s%s" % ((addr_fmt,)*4 + (addr_fmt,)*2),
+			name, type, flags, addr, offset, size, 0, 0, 1, 0
+		)
+
+	shdrs = shdr(0, 0, 0, 0, 0, 0) \
+			+ shdr(1, SHT_PROGBITS, SHF_ALLOC | SHF_EXECINSTR, vaddr, CODE_OFFSET, len(text)) \
+			+ shdr(7, SHT_STRTAB, 0, 0, shstrtab_off, len(shstrtab))
+
+	result = ehdr + phdr
+	result += "\0" * (CODE_OFFSET - len(result))
+	result += text + shstrtab
+	result += "\0" * (shoff - len(result))
+	return result + shdrs
+
+def write(path, arch, size, density, seed=0):
+	with open(path, "wb") as f:
+		f.write(elf(arch, size, density, seed))
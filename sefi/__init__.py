@@ -17,6 +17,15 @@ import argparse
 import sys
 import os.path
 import re
+import array
+import collections
+import binascii
+import inspect
+
+try:
+	import numpy
+except ImportError:
+	numpy = None
 
 from sefi.log import debug, info
 import sefi.container
@@ -25,6 +34,13 @@ import sefi.arch
 import sefi.disassembler
 from sefi import elf
 
+#terminators closer together than this many bytes can
+#produce the same gadget (see drop_repeats)
+WINDOW = 32
+
+#size of the pieces segments are split into for parallel searches
+CHUNK_SIZE = 0x4000
+
 def search_data_for_byte_seq(segments, byte_seq, backward_search):
 	bs_len = len(byte_seq)
 
@@ -38,21 +54,221 @@ def search_data_for_byte_seq(segments, byte_seq, backward_search):
 					yield gadget
 
 def search_data(segments, matcher, arch, backward_search):
+	for (gadget, matchers) in search_data_multi(segments, [matcher], arch, backward_search):
+		yield gadget
 
+def search_data_multi(segments, matchers, arch, backward_search, history=None, span_segments=False):
+	'''
+	search @segments for gadgets ending in an instruction
+	matched by any of the matchers in @matchers. each offset
+	is decoded only once and every matcher is evaluated against
+	that decode. yields (gadget, matchers) tuples, where the
+	second element is the list of matchers whose terminator
+	produced the gadget. if @history is given, decoded instructions
+	more than @history bytes behind the scan are discarded.
+	if @span_segments is true, gadgets are only yielded once a whole
+	segment has been searched, and then only the maximal gadgets across
+	all terminators of that segment, one per instruction sequence.
+	@backward_search is called as backward_search(iseq, matcher,
+	segment, offset, table) with the sefi.container.DecodeTable of the
+	segment as @table, unless it only takes the first four arguments.
+	'''
 	dasm = sefi.disassembler.find(arch)
+	backward_search = with_table(backward_search)
 	for segment in segments:
 		debug('search %d bytes starting at 0x%08x' % (len(segment.data), segment.base_addr))
 
-		for i in range(0, len(segment.data)):
-			iseq = sefi.container.InstSeq(
-				segment.base_addr+i,
-				segment.data[i:(i+32)], #ive heard maximum x86 len is 15, but im not sure
-				dasm
-			)
+		tagged = search_segment(segment, matchers, arch, dasm, backward_search, history)
+		if span_segments:
+			tagged = maximal_tagged_gadgets(tagged)
+
+		for result in tagged:
+			yield result
+
+def search_segment(segment, matchers, arch, dasm, backward_search, history=None, start=0, end=None):
+	'''
+	search a single segment like search_data_multi does, but only
+	for terminators at offsets in [@start, @end). bytes outside of
+	that range are still used by the backward search.
+	'''
+	if end is None:
+		end = len(segment.data)
+	backward_search = with_table(backward_search)
+
+	table = sefi.container.DecodeTable(
+		segment, dasm, sefi.arch.max_insn_len(arch),
+		align=sefi.arch.alignment(arch)
+	)
+	offsets = candidate_offsets(segment, matchers, arch, start, end, dasm.backend)
+	if offsets is None:
+		offsets = range(
+			sefi.arch.aligned(segment.base_addr, start, arch),
+			end,
+			sefi.arch.alignment(arch)
+		)
+	else:
+		debug('  %d candidate offsets' % len(offsets))
+
+	for i in offsets:
+		if history is not None:
+			table.discard_before(i - history)
+
+		ins = table.at(i)
+		if ins is None:
+			continue
 
-			if matcher(iseq):
-				for gadget in backward_search(iseq[0:1], matcher, segment, i):
-					yield gadget
+		iseq = sefi.container.InstSeq(
+			ins.addr, segment.data, dasm, [ins], i, i+len(ins)
+		)
+		fired = [m for m in matchers if m(iseq)]
+		if len(fired) < 1:
+			continue
+
+		for tagged in tag_gadgets(iseq, fired, segment, i, backward_search, table):
+			yield tagged
+
+def with_table(backward_search):
+	'''
+	returns @backward_search as a function which takes the decode
+	table of the search as its fifth argument. backward searches
+	written before the table was passed to them take four arguments
+	and are called without it.
+	'''
+	if getattr(backward_search, 'takes_table', False):
+		return backward_search
+
+	fn = backward_search
+	if not inspect.isfunction(fn) and not inspect.ismethod(fn):
+		fn = getattr(fn, '__call__', fn)
+
+	try:
+		spec = inspect.getargspec(fn)
+	except TypeError:
+		#not python code, so assume it takes the table
+		return backward_search
+
+	args = spec.args
+	if inspect.ismethod(fn):
+		args = args[1:]
+
+	if spec.varargs is not None or len(args) >= 5:
+		return backward_search
+
+	result = lambda seq, matcher, seg, offset, table: \
+		backward_search(seq, matcher, seg, offset)
+	result.takes_table = True
+	return result
+
+def maximal_tagged_gadgets(tagged):
+	'''
+	like maximal_unique_gadgets, but for (gadget, matchers) tuples.
+	the matchers of gadgets with the same instruction sequence
+	are merged into the tags of the one that is kept.
+	'''
+	trie = sefi.container.GadgetTrie()
+	for (gadget, ms) in tagged:
+		trie.insert(gadget, ms)
+
+	return trie.maximal()
+
+def candidate_offsets(segment, matchers, arch, start=0, end=None, backend=None):
+	'''
+	returns the sorted list of offsets in [@start, @end) of @segment
+	at which at least one of @matchers could match, found by scanning
+	the raw bytes for the byte signatures of the matchers. only offsets
+	at which an instruction of @arch can start are returned. returns None
+	if some matcher has no signature for @arch as decoded by the
+	disassembler backend named @backend, in which case every aligned
+	offset has to be disassembled.
+	'''
+	if end is None:
+		end = len(segment.data)
+	align = sefi.arch.alignment(arch)
+
+	if numpy is not None:
+		result = word_offsets(segment, matchers, arch, start, end, backend)
+		if result is not None:
+			return result
+
+	sigs = []
+	for m in matchers:
+		sig = m.signature(arch, backend)
+		if sig is None:
+			return None
+		sigs.append("(?:%s)" % sig)
+
+	reg = re.compile("(?=%s)" % "|".join(sigs), re.DOTALL)
+	result = []
+	#dont pass @end to finditer, the signature may need
+	#to look at bytes past the end of the range.
+	for m in reg.finditer(segment.data, start):
+		if m.start() >= end:
+			break
+		if (segment.base_addr + m.start()) % align == 0:
+			result.append(m.start())
+
+	return result
+
+def word_offsets(segment, matchers, arch, start, end, backend=None):
+	'''
+	the same as candidate_offsets, but for architectures whose
+	matchers describe their instructions as (mask, value) patterns
+	over 32 bit words (see Matcher.words). the segment is viewed as
+	an array of words from each of the 4 byte offsets in turn and
+	the patterns are tested against all the words at once. offsets
+	at which no instruction of @arch can start are skipped, so for
+	word aligned architectures only one of the views is scanned.
+	returns None if some matcher has no word patterns for @arch
+	as decoded by @backend.
+	'''
+	patterns = []
+	for m in matchers:
+		words = m.words(arch, backend)
+		if words is None:
+			return None
+		patterns.extend(words)
+
+	size = len(segment.data)
+	hits = []
+	align = sefi.arch.alignment(arch)
+	for phase in range(4):
+		first = start + phase
+		if (segment.base_addr + first) % align != 0:
+			continue
+		count = (min(end, size - 3) - first + 3) // 4
+		if count < 1:
+			continue
+
+		words = numpy.frombuffer(segment.data, dtype='<u4', count=count, offset=first)
+		match = numpy.zeros(count, dtype=bool)
+		for (mask, value) in patterns:
+			match |= (words & mask) == value
+
+		hits.append(numpy.flatnonzero(match) * 4 + first)
+
+	if len(hits) < 1:
+		return []
+
+	return sorted(numpy.concatenate(hits).tolist())
+
+def tag_gadgets(iseq, matchers, segment, offset, backward_search, table):
+	'''
+	run the backward search from @offset once for each matcher
+	in @matchers and merge the results, so that a gadget found
+	by more than one matcher is only yielded once.
+	'''
+	tags = {}
+	gadgets = []
+
+	for m in matchers:
+		for gadget in backward_search(iseq, m, segment, offset, table):
+			if gadget not in tags:
+				tags[gadget] = []
+				gadgets.append(gadget)
+			tags[gadget].append(m)
+
+	for gadget in gadgets:
+		yield (gadget, tags[gadget])
 
 def backward_search_n_from_byte_seq(byte_seq, segment, offset, arch, n):
 	dasm = sefi.disassembler.find(arch)
@@ -66,8 +282,8 @@ def backward_search_n_from_byte_seq(byte_seq, segment, offset, arch, n):
 		None, segment, offset, n
 	)
 
-def backward_search_n(iseq, matcher, segment, offset, n):
-	bs_len = len(iseq.data)
+def backward_search_n(iseq, matcher, segment, offset, n, table=None):
+	bs_len = iseq.data_len()
 	base_addr = segment.base_addr+offset
 	gadgets = []
 	is_len = len(iseq)
@@ -76,59 +292,87 @@ def backward_search_n(iseq, matcher, segment, offset, n):
 	if is_len < 1:
 		raise Exception("invalid instruction sequence: %r" % iseq)
 
-	debug("backward search from 0x%08x for sequences ending in %s" % (base_addr, iseq) )
+	arch = dasm.arch()
+	align = sefi.arch.alignment(arch)
+	if table is None:
+		table = sefi.container.DecodeTable(
+			segment, dasm, sefi.arch.max_insn_len(arch), align=align
+		)
 
-	for i in range(1, n+1):
-		data = segment.data[(offset-i):(offset+bs_len)]
-		new_seq = sefi.container.InstSeq(base_addr-i, data, dasm)
-		ns_len = len(new_seq)
+	debug("backward search from 0x%08x for sequences ending in %s" % (base_addr, iseq) )
 
-		if ns_len <= is_len:
+	end = offset + bs_len
+	lo = max(0, offset - n)
+
+	#every offset in [lo, end) points to the offset of the instruction
+	#that follows it, which makes a graph of all the decode paths
+	#leading up to the terminator. the graph is walked over the length
+	#and flags columns of the decode table. term[s-lo] is the offset of
+	#the terminator reached by decoding linearly from s, or -1 if that
+	#decode does not land exactly on a terminator. path[s-lo] holds the
+	#classification bits of all the instructions between s and the
+	#terminator. both are filled in walking backwards from the
+	#terminator, so each path is only evaluated once, and a bad
+	#instruction marks every longer start offset running through it
+	#at the same time. only the offsets at which an instruction can
+	#start are visited.
+	(lengths, flags) = table.columns(lo, end)
+	size = end - lo
+	term = array.array('i', [-1]) * size
+	path = array.array('I', [0]) * size
+	top = end - 1 - (segment.base_addr + end - 1) % align
+	for s in range(top, lo-1, -align):
+		k = s - lo
+		if is_terminator(iseq, table, s, end):
+			term[k] = s
 			continue
 
-		#prefix is the gadget terminator at the END of the sequence
-		prefix = new_seq[-is_len:]
-		#if the prefix is not the same as the iseq we are looking for 
-		#(a gadget terminator like "ret"), then skip this offset
-		if not iseq.proc_equal(prefix):
+		nxt = k + lengths[k]
+		if nxt == k or nxt >= size:
 			continue
 
+		term[k] = term[nxt]
+		path[k] = flags[k] | path[nxt]
+
+	mask = disallowed_flags(matcher)
+	for i in range(1, n+1):
+		start = offset - i
+		if start < lo:
+			break
+
 		#sometimes the prefix we are looking for can be encoded
 		#in equivalent ways. in some cases the prefix will in fact
 		#be longer than the original @byte_seq that we used to
-		#prototype it. in this case we have to correct the offset
-		#of the prefix from the base address of the gadget.
-		real_prefix_offset = i + bs_len - len(prefix.data)
-		g = sefi.container.Gadget(base_addr - i, data, dasm, real_prefix_offset)
+		#prototype it, so the offset of the prefix from the base
+		#address of the gadget is taken from where the decode
+		#actually met the terminator.
+		prefix_offset = term[start - lo]
+		if prefix_offset < 0 or prefix_offset == start:
+			continue
+
+		g = sefi.container.Gadget(
+			segment.base_addr + start,
+			segment.data,
+			dasm,
+			prefix_offset - start,
+			table.chain(start, end),
+			start,
+			end
+		)
 
 		#if we find the same sequence preceding this one
 		#we should have already looked at that so we can stop here
 		if g.suffix().proc_equal(iseq):
 			break
 
-		if matcher:
-			#besides finding the exact same prefix repeated, we might
-			#also find another prefix/terminator which also matches,
-			#in which case we should have already found that sequence so
-			#we can stop here.
-			if matcher(g.suffix()):
-				break
-
-			if not matcher.allow_uncond_flow():
-				if g.suffix().has_uncond_ctrl_flow():
-					continue
-
-			if not matcher.allow_cond_flow():
-				if g.suffix().has_cond_ctrl_flow():
-					continue
-
-		#a gadget with a ret in the middle wont be
-		#useful
-		if g.suffix().test_for(lambda ins: ins.ret()):
-			continue
+		#besides finding the exact same prefix repeated, we might
+		#also find another prefix/terminator which also matches,
+		#in which case we should have already found that sequence so
+		#we can stop here.
+		if matcher and matcher(g.suffix()):
+			break
 
-		if g.has_bad_ins():
-			#debug("found bad instruction, skipping...")
+		if path[start - lo] & mask:
 			continue
 
 		cg = g.compact()
@@ -141,47 +385,276 @@ def backward_search_n(iseq, matcher, segment, offset, n):
 		else:
 			pass #debug("compacted gadget was empty: \n%r" % g)
 
-	for gadget in maximal_unique_gadgets(gadgets, []):
+	for gadget in maximal_unique_gadgets(gadgets):
 		yield gadget
 
-def maximal_unique_gadgets(gadgets, prefix = []):
-	next_pre = {}
-	arr_len = len(gadgets)
-	plen = len(prefix)
+def is_terminator(iseq, table, start, end):
+	'''
+	does linearly decoding @table from @start up to @end give
+	exactly the instructions of @iseq?
+	'''
+	insns = table.chain(start, end, len(iseq))
+	if insns is None or len(insns) != len(iseq):
+		return False
+
+	return iseq.proc_equal(sefi.container.InstSeq(
+		insns[0].addr,
+		table.segment.data,
+		iseq.dasm,
+		insns,
+		start,
+		end
+	))
+
+def allowed_in_gadget(ins, matcher):
+	'''
+	can @ins appear before the terminator of a gadget
+	found by @matcher?
+	'''
+	return (ins.flags & disallowed_flags(matcher)) == 0
+
+def disallowed_flags(matcher):
+	'''
+	returns the classification bits which rule an instruction
+	out of the gadgets found by @matcher.
+	'''
+	#a gadget with a ret in the middle wont be
+	#useful
+	mask = sefi.disassembler.RET | sefi.disassembler.BAD
+
+	if matcher:
+		if not matcher.allow_uncond_flow():
+			mask |= sefi.disassembler.UNCOND
+
+		if not matcher.allow_cond_flow():
+			mask |= sefi.disassembler.COND
+
+	return mask
+
+def maximal_unique_gadgets(gadgets):
+	'''
+	returns the gadgets in @gadgets whose instruction sequence
+	is not the tail end of a longer gadget in @gadgets. of several
+	gadgets with the same sequence only the first is kept.
+	'''
+	trie = sefi.container.GadgetTrie()
+	for g in gadgets:
+		trie.insert(g)
 
-	#debug("maximal unique gadgets:")
-	#debug("gadgets: ")
-	#for g in gadgets:
-	#	debug("  %r" % g.as_prefix()[plen:])
-	#debug("prefix: %r" % prefix)
+	return [g for (g, tags) in trie.maximal()]
 
-	if arr_len <= 1:
-		#debug(" => return %r" % list(map(lambda iseq: iseq.str_seq(), gadgets)) )
-		return gadgets
+def search_elf_for_gadgets(io, backward_search_amt, matcher):
+	return (
+		gadget for (gadget, matchers) in \
+			search_elf_for_gadgets_multi(io, backward_search_amt, [matcher])
+	)
 
-	for g in gadgets:
-		g_seq = g.as_prefix()[plen:]
-		if len(g_seq) < 1:
+def search_elf_for_gadgets_multi(io, backward_search_amt, matchers, jobs=1):
+	'''
+	like search_elf_for_gadgets, but searches for all @matchers at
+	once and yields (gadget, matchers) tuples. if @jobs is greater
+	than one, the executable segments are searched by a pool of
+	@jobs processes.
+	'''
+	elf_o, arch = elf.open(io)
+
+	if jobs > 1:
+		return drop_repeats(search_data_parallel(
+			elf.executable_data(elf_o),
+			matchers,
+			arch,
+			backward_search_amt,
+			jobs
+		))
+	
+	backward_search = lambda seq, matcher, seg, offset, table: \
+		backward_search_n(seq, matcher, seg, offset, backward_search_amt, table)
+
+	return drop_repeats(search_data_multi(
+		elf.executable_data(elf_o),
+		matchers,
+		arch,
+		backward_search,
+		backward_search_amt
+	))
+
+def drop_repeats(tagged, distance=WINDOW):
+	'''
+	the same gadget can be found from terminators at nearby
+	offsets, e.g. from a RET and from the same RET behind a
+	prefix byte. filter out such repeats from the (gadget, matchers)
+	tuples in @tagged while only remembering the gadgets whose
+	terminator is within @distance bytes of the current one.
+	'''
+	recent = collections.deque()
+	seen = set([])
+
+	for (gadget, ms) in tagged:
+		term = gadget.addr() + gadget.parent_offset
+		while len(recent) > 0 and recent[0][0] < term - distance:
+			seen.discard(recent.popleft()[1])
+
+		if gadget in seen:
 			continue
 
-		head, tail = g_seq[0], g_seq[1:]
-		if head not in next_pre:
-			next_pre[head] = [g]
-		else:
-			next_pre[head].append(g)
+		seen.add(gadget)
+		recent.append((term, gadget))
+		yield (gadget, ms)
+
+def search_elf_for_gadget_records(io, backward_search_amt, matchers, jobs=1):
+	'''
+	streaming form of search_elf_for_gadgets_multi: yields a
+	gadget_record for each gadget as soon as the backward search
+	from its terminator has finished. nothing is accumulated across
+	terminators, so memory use does not grow with the number of
+	gadgets found.
+	'''
+	for (gadget, ms) in search_elf_for_gadgets_multi(
+				io, backward_search_amt, matchers, jobs):
+		yield gadget_record(gadget, ms)
+
+def gadget_record(gadget, matchers):
+	'''
+	returns a dict describing @gadget which can be serialized
+	as json. @matchers is the list of matchers that found it.
+	'''
+	if gadget.has_uncond_ctrl_flow():
+		flow = "uncond"
+	elif gadget.has_cond_ctrl_flow():
+		flow = "cond"
+	else:
+		flow = "none"
+
+	return {
+		"addr": gadget.addr(),
+		"bytes": binascii.hexlify(gadget.data),
+		"insns": list(gadget.suffix().str_seq()),
+		"terminator": list(gadget.prefix().str_seq()),
+		"flow": flow,
+		"matchers": [m.name() for m in matchers]
+	}
+
+def duplicate_record(gadget, group, matchers):
+	'''
+	returns a dict which can be serialized as json saying that
+	@gadget, found by @matchers, has the same instructions as the
+	representative gadget of the sefi.container.UniqueGadgetIndex
+	group @group. "group_matchers" lists the tags of the group
+	after @matchers were merged into them.
+	'''
+	return {
+		"addr": gadget.addr(),
+		"same_as": group.gadget.addr(),
+		"matchers": [m.name() for m in matchers],
+		"group_matchers": [m.name() for m in group.tags]
+	}
+
+def chunk_segments(segments, n, arch, chunk_size=CHUNK_SIZE):
+	'''
+	split @segments into pieces for a parallel search. yields
+	(segment, start, end) tuples where the terminators at offsets
+	[start, end) of the piece belong to that piece. each piece
+	overlaps its neighbours by the @n bytes the backward search
+	looks back plus enough bytes to decode the last instructions
+	of @arch exactly as a search over the whole segment would.
+	'''
+	after = 2*sefi.arch.max_insn_len(arch)
+	for segment in segments:
+		size = len(segment.data)
+		for lo in range(0, size, chunk_size):
+			hi = min(lo + chunk_size, size)
+			dlo = max(0, lo - n)
+			dhi = min(size, hi + after)
+
+			yield (
+				sefi.container.Segment(
+					segment.data[dlo:dhi],
+					segment.base_addr + dlo
+				),
+				lo - dlo,
+				hi - dlo
+			)
+
+worker_state = {}
+
+def init_worker(backend, arch, rankings, matchers, n):
+	for (name, rank) in rankings.items():
+		sefi.disassembler.backend_set_rank(name, rank)
+
+	worker_state['dasm'] = sefi.disassembler.recreate(backend, arch)
+	worker_state['arch'] = arch
+	worker_state['matchers'] = matchers
+	worker_state['n'] = n
+
+def search_chunk(chunk):
+	'''
+	search one piece produced by chunk_segments inside a worker
+	process. the gadgets are returned as plain tuples of
+	(addr, data, parent_offset, matcher indices, instructions)
+	because disassembled instructions cannot always be pickled.
+	each instruction is a (length, text, flags) tuple, which is
+	enough for the parent to rebuild the gadget with
+	Disassembler.rebuild instead of decoding it again. they are
+	returned together with the hits and misses of the decode cache
+	of the worker during the search.
+	'''
+	(segment, start, end) = chunk
+	dasm = worker_state['dasm']
+	cache = sefi.disassembler.decode_cache
+	(hits, misses) = (cache.hits, cache.misses)
+	matchers = worker_state['matchers']
+	n = worker_state['n']
+
+	backward_search = lambda seq, matcher, seg, offset, table: \
+		backward_search_n(seq, matcher, seg, offset, n, table)
 
 	result = []
-	for head, gadgets in next_pre.items():
-		#debug("head:gadgets -> %r:%r\n" % (head, map(lambda g: g.as_prefix(), gadgets)) )
-		result += maximal_unique_gadgets(gadgets, prefix + [head])
-	
-	return result
+	for (gadget, ms) in search_segment(
+				segment, matchers, worker_state['arch'], dasm,
+				backward_search, n, start, end):
+		result.append((
+			gadget.addr(),
+			gadget.data,
+			gadget.parent_offset,
+			[matchers.index(m) for m in ms],
+			[(len(ins), str(ins), ins.flags) for ins in gadget]
+		))
+
+	return (result, cache.hits - hits, cache.misses - misses)
+
+def search_data_parallel(segments, matchers, arch, n, jobs, chunk_size=CHUNK_SIZE):
+	'''
+	search @segments like search_data_multi with a backward search
+	of @n bytes, but split the segments into overlapping pieces and
+	search them in a pool of @jobs processes. the gadgets are yielded
+	in the same order as a serial search would yield them. the hits
+	and misses of the decode caches of the workers are added to
+	those of sefi.disassembler.decode_cache.
+	'''
+	import multiprocessing
 
-def search_elf_for_gadgets(io, backward_search_amt, matcher):
-	elf_o, arch = elf.open(io)
-	
-	backward_search = lambda seq, matcher, seg, offset: \
-		backward_search_n(seq, matcher, seg, offset, backward_search_amt)
+	dasm = sefi.disassembler.find(arch)
+	pool = multiprocessing.Pool(
+		jobs,
+		init_worker,
+		(dasm.backend, arch, dict(sefi.disassembler.rankings), matchers, n)
+	)
 
-	return search_data(elf.executable_data(elf_o), matcher, arch, backward_search)
-	
+	try:
+		chunks = chunk_segments(segments, n, arch, chunk_size)
+		for (result, hits, misses) in pool.imap(search_chunk, chunks):
+			sefi.disassembler.decode_cache.hits += hits
+			sefi.disassembler.decode_cache.misses += misses
+			for (addr, data, parent_offset, indices, decoded) in result:
+				insns = []
+				p = 0
+				for (length, text, flags) in decoded:
+					insns.append(dasm.rebuild(addr+p, data[p:p+length], text, flags))
+					p += length
+
+				yield (
+					sefi.container.Gadget(addr, data, dasm, parent_offset, insns),
+					[matchers[i] for i in indices]
+				)
+	finally:
+		pool.terminate()
@@ -22,17 +22,40 @@ class UnknownElfArch(ArchErr):
 	pass
 
 arches = []
+alignments = {}
+max_lengths = {}
 
-def add_arch(arch):
+def add_arch(arch, alignment=1, max_len=16):
+	'''
+	@alignment: instructions of @arch start at addresses
+	which are a multiple of this many bytes.
+	@max_len: the length in bytes of the longest instruction
+	of @arch.
+	'''
 	arches.append(arch)
+	alignments[arch] = alignment
+	max_lengths[arch] = max_len
 	return arch
 
-x86 	= add_arch("x86")
-x86_64 	= add_arch("x86-64")
-arm		= add_arch("arm")
-thumb1	= add_arch("thumb")
-thumb2	= add_arch("thumb2")
-mips	= add_arch("mips")
+x86 	= add_arch("x86", 1, 15)
+x86_64 	= add_arch("x86-64", 1, 15)
+arm		= add_arch("arm", 4, 4)
+thumb1	= add_arch("thumb", 2, 2)
+thumb2	= add_arch("thumb2", 2, 4)
+mips	= add_arch("mips", 4, 4)
+
+def alignment(arch):
+	return alignments.get(arch, 1)
+
+def max_insn_len(arch):
+	return max_lengths.get(arch, 16)
+
+def aligned(base_addr, offset, arch):
+	'''
+	returns the first offset at or after @offset from @base_addr
+	at which an instruction of @arch can start.
+	'''
+	return offset + (-(base_addr + offset) % alignment(arch))
 
 def from_elf_machine_arch(machine_arch):
 	ma = machine_arch.strip()
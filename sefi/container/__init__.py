@@ -13,13 +13,18 @@
 #  
 # You should have received a copy of the GNU General Public License
 # along with sefi.  If not, see <http://www.gnu.org/licenses/>.
+import array
+import itertools
+
 import sefi.disassembler
 
 class Segment(object):
 	'''
 	a physically (at load time, not necessarily on file) contiguous 
 	list of bytes from a file. 
-	@data: the bytes as they will be projected at load time.
+	@data: the bytes as they will be projected at load time. instruction
+	sequences decoded from the segment refer to windows of this buffer
+	instead of copying it.
 	@base_addr: the base virtual address from which the segment begins
 	'''
 
@@ -27,6 +32,275 @@ class Segment(object):
 		self.data = data
 		self.base_addr = base_addr
 
+class DecodeTable(object):
+	'''
+	decodes the instruction starting at each byte offset of
+	@segment lazily, the first time the offset is requested, and
+	remembers the result. the forward scan and the backward search
+	both walk the same table, so each offset is decoded at most once.
+	@window: the number of bytes handed to the disassembler for
+	each decode.
+	@cache: the sefi.disassembler.DecodeCache to decode through.
+	defaults to sefi.disassembler.decode_cache.
+	@align: only addresses which are a multiple of this are
+	decoded by prefetch.
+	'''
+
+	def __init__(self, segment, dasm, window=32, cache=None, align=1):
+		self.segment = segment
+		self.dasm = dasm
+		self.window = window
+		self.align = align
+		if cache is None:
+			cache = sefi.disassembler.decode_cache
+		self.cache = cache
+		self.insns = {}
+		self.low = 0
+
+	def at(self, offset):
+		'''
+		returns the instruction starting at @offset, or None if
+		nothing could be decoded there.
+		'''
+		if offset in self.insns:
+			return self.insns[offset]
+
+		ins = None
+		if offset >= 0 and offset < len(self.segment.data):
+			ins = self.cache.first(
+				self.dasm,
+				self.segment.base_addr+offset,
+				self.segment.data,
+				offset,
+				self.window
+			)
+
+		self.insns[offset] = ins
+		return ins
+
+	def prefetch(self, start, end):
+		'''
+		decode every aligned offset in [@start, @end) that hasnt
+		been decoded yet. offsets the cache cant answer are decoded
+		together with one call to the batch decoder of the
+		disassembler.
+		'''
+		missing = []
+		uncacheable = set()
+		start = max(start, 0)
+		start += -(self.segment.base_addr + start) % self.align
+		for i in xrange(start, min(end, len(self.segment.data)), self.align):
+			if i in self.insns:
+				continue
+
+			ins = self.cache.lookup(
+				self.dasm,
+				self.segment.base_addr+i,
+				self.segment.data,
+				i,
+				self.window
+			)
+			if ins is None or ins is False:
+				missing.append(i)
+				if ins is False:
+					uncacheable.add(i)
+			else:
+				self.insns[i] = ins
+
+		if len(missing) < 1:
+			return
+
+		if self.cache.size > 0:
+			self.cache.misses += len(missing)
+
+		decoded = self.dasm.decode_at_offsets(
+			self.segment.data,
+			self.segment.base_addr,
+			missing
+		)
+		for (i, insns) in decoded.iteritems():
+			ins = insns[0] if len(insns) > 0 else None
+			self.insns[i] = ins
+			if i not in uncacheable:
+				self.cache.store(self.dasm, self.segment.data, i, ins)
+
+	def columns(self, start, end):
+		'''
+		decodes [@start, @end) like prefetch and returns it as two
+		columns indexed by the offset minus @start: the length of the
+		instruction at each offset and its classification bits (see
+		sefi.disassembler.Instr.flags). the length is 0 where nothing
+		could be decoded or no instruction can start.
+		'''
+		self.prefetch(start, end)
+		size = max(0, end - start)
+		lengths = array.array('B', [0]) * size
+		flags = array.array('I', [0]) * size
+		first = max(start, 0)
+		first += -(self.segment.base_addr + first) % self.align
+		for i in xrange(first, min(end, len(self.segment.data)), self.align):
+			ins = self.at(i)
+			if ins is not None:
+				lengths[i - start] = len(ins)
+				flags[i - start] = ins.flags
+
+		return (lengths, flags)
+
+	def chain(self, start, end, limit=None):
+		'''
+		returns the list of instructions obtained by decoding
+		linearly from @start, or None if that sequence does not
+		end exactly at @end or would be longer than @limit
+		instructions.
+		'''
+		result = []
+		offset = start
+		while offset < end:
+			if limit is not None and len(result) >= limit:
+				return None
+
+			ins = self.at(offset)
+			if ins is None or len(ins) < 1:
+				return None
+			result.append(ins)
+			offset += len(ins)
+
+		if offset != end:
+			return None
+
+		return result
+
+	def discard_before(self, offset):
+		'''
+		forget the decoded instructions at offsets below @offset
+		so that a forward scan only holds a bounded window.
+		'''
+		for i in range(self.low, offset):
+			self.insns.pop(i, None)
+
+		self.low = max(self.low, offset)
+
+class GadgetTrie(object):
+	'''
+	a trie of gadgets keyed on their instruction text ids read
+	backwards from the terminator, so gadgets which share a tail
+	share a path. a gadget whose path ends in a node with children
+	is the tail end of a longer gadget.
+	'''
+
+	class Node(object):
+		__slots__ = ('children', 'gadget', 'tags')
+
+		def __init__(self):
+			self.children = {}
+			self.gadget = None
+			self.tags = None
+
+	def __init__(self):
+		self.root = self.__class__.Node()
+		self.inserted = []
+
+	def insert(self, gadget, tags=None):
+		'''
+		add @gadget to the trie. if another gadget with the same
+		instruction sequence was inserted before, @gadget is dropped
+		and @tags are merged into the tags of the earlier one.
+		'''
+		node = self.root
+		for tid in reversed(gadget.text_seq()):
+			if tid not in node.children:
+				node.children[tid] = self.__class__.Node()
+			node = node.children[tid]
+
+		if node.gadget is None:
+			node.gadget = gadget
+			node.tags = []
+			self.inserted.append(node)
+
+		if tags is not None:
+			for t in tags:
+				if t not in node.tags:
+					node.tags.append(t)
+
+	def maximal(self):
+		'''
+		returns (gadget, tags) tuples for the gadgets at the leaves
+		of the trie, in the order they were inserted.
+		'''
+		return [
+			(node.gadget, node.tags) for node in self.inserted \
+				if len(node.children) < 1
+		]
+
+class UniqueGadgetIndex(object):
+	'''
+	groups gadgets by their normalized instruction sequence.
+	each group keeps the first gadget added to it as its
+	representative and only the addresses of the others.
+	'''
+
+	class Group(object):
+		__slots__ = ('seq', 'gadget', 'addrs', 'tags')
+
+		def __init__(self, seq, gadget):
+			self.seq = seq
+			self.gadget = gadget
+			self.addrs = []
+			self.tags = []
+
+		def add(self, gadget, tags):
+			self.addrs.append(gadget.addr())
+			if tags is not None:
+				for t in tags:
+					if t not in self.tags:
+						self.tags.append(t)
+
+	def __init__(self):
+		#normalized sequence -> group
+		self.by_seq = {}
+		self.groups = []
+		#text id -> text id of the normalized text
+		self.normal_ids = {}
+
+	def normalize(self, gadget):
+		'''
+		returns the text ids of the instructions of @gadget
+		after collapsing whitespace and upper casing them.
+		'''
+		seq = []
+		for tid in gadget.text_seq():
+			nid = self.normal_ids.get(tid)
+			if nid is None:
+				nid = sefi.disassembler.text_id(" ".join(tid.split()).upper())
+				self.normal_ids[tid] = nid
+			seq.append(nid)
+
+		return tuple(seq)
+
+	def add(self, gadget, tags=None):
+		'''
+		add @gadget to the group for its instruction sequence.
+		returns a tuple of the group and whether the group
+		was created by this call.
+		'''
+		seq = self.normalize(gadget)
+		group = self.by_seq.get(seq)
+		if group is not None:
+			group.add(gadget, tags)
+			return (group, False)
+
+		group = self.__class__.Group(seq, gadget)
+		group.add(gadget, tags)
+		self.by_seq[seq] = group
+		self.groups.append(group)
+		return (group, True)
+
+	def __len__(self):
+		return len(self.groups)
+
+	def __iter__(self):
+		return iter(self.groups)
+
 class InstSeq(object):
 
 	@staticmethod
@@ -35,24 +309,42 @@ class InstSeq(object):
 
 		return InstSeq(base_addr, data, dasm)
 
-	def __init__(self, base_addr, data, dasm):
+	def __init__(self, base_addr, data, dasm, insns=None, start=0, end=None, lo=0, hi=None):
+		'''
+		@data: the bytes of the sequence, or a larger buffer (such as
+		the data of a Segment) of which only the window [@start, @end)
+		belongs to this sequence. the buffer is shared, not copied.
+		@insns: optional list of instructions already decoded
+		from the window, used instead of decoding it again.
+		@lo, @hi: if given, only @insns[@lo:@hi] are the instructions
+		of the window. this lets a slice share the instructions of
+		the sequence it was taken from.
+		'''
 		self.base_addr = base_addr
-		self.data = data
+		self.buf = data
 		self.dasm = dasm
+		self.insns = None if insns is None else tuple(insns)
+		self.lo = lo
+		self.hi = hi
+		if self.insns is not None and hi is None:
+			self.hi = len(self.insns)
+		self._str_seq = None
+		self._text_seq = None
+		self._digest = None
 
 		if not isinstance(self.base_addr, int) and \
 				not isinstance(self.base_addr, long):
 			raise TypeError("invalid base_addr: %r(%s)" % (self.base_addr, type(self.base_addr)))
 
-		if isinstance(self.data, str):
-			self.data = tuple([ord(x) for x in self.data])
-		elif isinstance(self.data, bytes) or \
-				isinstance(self.data, bytearray):
-			self.data = tuple(l)
-		elif isinstance(self.data, tuple):
-			pass
-		else:
-			raise TypeError("invalid data: %r(%s)" % (self.data, type(self.data)))
+		if isinstance(self.buf, tuple):
+			self.buf = sefi.disassembler.window_bytes(self.buf)
+		elif not isinstance(self.buf, (str, bytearray, memoryview)):
+			raise TypeError("invalid data: %r(%s)" % (self.buf, type(self.buf)))
+
+		if end is None:
+			end = len(self.buf)
+		self.start = start
+		self.end = end
 
 		if not isinstance(self.dasm, sefi.disassembler.Disassembler):
 			raise TypeError("invalid dasm: %r" % self.dasm)		
@@ -77,12 +369,32 @@ class InstSeq(object):
 	def __delattr__(self, *ignored):
 		return self.immutable_exception()
 
+	def memoize(self, name, value):
+		'''
+		the sequence is immutable, so anything derived from it
+		can be computed once and kept. this stores such a value
+		without tripping the freeze in __setattr__.
+		'''
+		self.__dict__[name] = value
+		return value
+
 	def __hash__(self):
 		return hash((
 			self.addr(),
-			self.arch(),
-			self.data
+			self.digest()
 		))
+
+	@property
+	def data(self):
+		'''the bytes of this sequence as a str'''
+		return sefi.disassembler.window_bytes(
+			self.buf,
+			self.start,
+			self.end - self.start
+		)
+
+	def data_len(self):
+		return self.end - self.start
 		
 	def arch(self):
 		return self.dasm.arch()
@@ -91,25 +403,77 @@ class InstSeq(object):
 		return self.base_addr
 
 	def disassembly(self):
-		return self.dasm.decode(self.addr(), self.data)
+		'''
+		the instructions of this sequence as a tuple. the window is
+		only decoded the first time this is called.
+		'''
+		if self.insns is None:
+			insns = tuple(self.dasm.decode(
+				self.addr(),
+				self.buf,
+				self.start,
+				self.end - self.start
+			))
+		elif self.lo == 0 and self.hi == len(self.insns):
+			return self.insns
+		else:
+			#a slice only copies its part of the instructions
+			#it shares when they are asked for as a tuple
+			insns = self.insns[self.lo:self.hi]
+
+		self.memoize('lo', 0)
+		self.memoize('hi', len(insns))
+		return self.memoize('insns', insns)
+
+	def __iter__(self):
+		if self.insns is None:
+			self.disassembly()
+
+		return itertools.islice(self.insns, self.lo, self.hi)
 
 	def __getitem__(self, key):
 		if type(key) is int:
-			return list(self.disassembly())[key]
+			if self.insns is None:
+				self.disassembly()
+
+			if key < 0:
+				key += len(self)
+			if key < 0 or key >= len(self):
+				raise IndexError("instruction index out of range")
+
+			return self.insns[self.lo + key]
 
 		elif type(key) is slice:
-			arr = list(self.disassembly())[key]
-			if len(arr) < 1:
+			(lo, hi, step) = key.indices(len(self))
+			if step != 1:
+				arr = self.disassembly()[key]
+				if len(arr) < 1:
+					raise TypeError("invalid key: %r" % key)
+
+				return InstSeq(
+					arr[0].addr,
+					self.buf,
+					self.dasm,
+					arr,
+					self.start + (arr[0].addr - self.addr()),
+					self.start + (arr[0].addr - self.addr()) + sum(map(len, arr))
+				)
+
+			if hi <= lo:
 				raise TypeError("invalid key: %r" % key)
 
+			first = self.insns[self.lo + lo]
+			last = self.insns[self.lo + hi - 1]
+			start = self.start + (first.addr - self.addr())
 			return InstSeq(
-				arr[0].addr,
-				reduce(
-					lambda sum, y: sum + y.data,
-					arr[1:],
-					arr[0].data
-				),
-				self.dasm
+				first.addr,
+				self.buf,
+				self.dasm,
+				self.insns,
+				start,
+				start + (last.addr - first.addr) + len(last),
+				self.lo + lo,
+				self.lo + hi
 			)
 
 
@@ -126,23 +490,49 @@ class InstSeq(object):
 		if not isinstance(other, InstSeq):
 			raise TypeError("invalid other: %r(%s)" % (other, type(other)))
 
-		return self.same_str_seq(other.str_seq())
+		if self.digest() != other.digest():
+			return False
+
+		return self.text_seq() == other.text_seq()
 
 
 	def __list__(self):
 		return list(self.disassembly())
 
 	def __len__(self):
-		return len(list(self.disassembly()))
+		if self.insns is None:
+			self.disassembly()
+
+		return self.hi - self.lo
 
 	def __reversed__(self):
-		return reversed(list(self))
+		return reversed(self.disassembly())
 
 	def str_seq(self):
-		return map(
-			lambda insn: str(insn),
-			self.disassembly()
-		)
+		if self._str_seq is not None:
+			return self._str_seq
+
+		return self.memoize('_str_seq', tuple(map(str, self)))
+
+	def text_seq(self):
+		'''
+		the text ids (see sefi.disassembler.text_id) of the
+		instructions. two sequences have the same text ids
+		exactly when they have the same string sequence.
+		'''
+		if self._text_seq is not None:
+			return self._text_seq
+
+		return self.memoize('_text_seq', tuple([
+			ins.text_id for ins in self
+		]))
+
+	def digest(self):
+		'''a hash of text_seq, for comparing sequences quickly'''
+		if self._digest is not None:
+			return self._digest
+
+		return self.memoize('_digest', hash(self.text_seq()))
 	
 	def as_prefix(self):
 		return list(reversed(self.str_seq()))
@@ -169,7 +559,7 @@ class InstSeq(object):
 		if len(ss) != len(str_seq):
 			return False
 
-		for (x,y) in zip(self.str_seq(), str_seq):
+		for (x,y) in zip(ss, str_seq):
 			if x != y:
 				return False 
 	
@@ -189,12 +579,26 @@ class InstSeq(object):
 
 		return False
 
+	def test_flags(self, mask):
+		'''
+		does any instruction in this sequence have any of the
+		classification bits in @mask set?
+		'''
+		for ins in self:
+			if ins.flags & mask:
+				return True
+
+		return False
+
 	def nop(self):
 		'''is this a sequence of nops?'''
-		return not self.test_for(lambda ins: not ins.nop())
+		for ins in self:
+			if not ins.flags & sefi.disassembler.NOP:
+				return False
+
+		return True
 
 	def without_nop_prefix(self):
-		str_seq = self.str_seq()
 		for offset in range(0, len(self)):
 			if not self[offset].nop():
 				break
@@ -202,22 +606,23 @@ class InstSeq(object):
 		return self[offset:]
 		
 	def has_uncond_ctrl_flow(self):
-		return self.test_for(lambda ins: ins.has_uncond_ctrl_flow())
+		return self.test_flags(sefi.disassembler.UNCOND)
 
 	def has_cond_ctrl_flow(self):
-		return self.test_for(lambda ins: ins.has_cond_ctrl_flow())
+		return self.test_flags(sefi.disassembler.COND)
 
 	def has_ctrl_flow(self):
-		return self.has_uncond_ctrl_flow() or self.has_cond_ctrl_flow()
+		return self.test_flags(sefi.disassembler.COND | sefi.disassembler.UNCOND)
 
 	def has_bad_ins(self):
-		return self.test_for(lambda ins: ins.bad() )
+		return self.test_flags(sefi.disassembler.BAD)
 
 class Gadget(InstSeq):
 	
-	def __init__(self, addr, data, dasm, parent_offset):
+	def __init__(self, addr, data, dasm, parent_offset, insns=None, start=0, end=None, lo=0, hi=None):
 		self.parent_offset = parent_offset
-		super(Gadget, self).__init__(addr, data, dasm)
+		self._split = None
+		super(Gadget, self).__init__(addr, data, dasm, insns, start, end, lo, hi)
 
 	def nop(self):
 		return self.suffix().nop()
@@ -230,14 +635,80 @@ class Gadget(InstSeq):
 		suf = self.suffix()
 		if suf[0].nop():
 			suf = suf.without_nop_prefix()
+			if suf.insns is self.insns:
+				#the suffix is still a view of the instructions
+				#of this gadget, which run up to the end of it
+				(insns, lo, hi) = (self.insns, suf.lo, self.hi)
+			else:
+				insns = suf.disassembly() + self.parent().disassembly()
+				(lo, hi) = (0, None)
+
 			return Gadget(
 				suf.addr(),
-				suf.data + self.prefix().data,
+				self.buf,
 				self.dasm,
-				len(suf.data)
+				suf.data_len(),
+				insns,
+				suf.start,
+				self.end,
+				lo,
+				hi
 			)
 		else:
 			return self
+
+	def split(self):
+		'''
+		returns the suffix and the parent of this gadget as a
+		pair of views which share the instructions decoded for
+		the whole gadget, so the gadget is only decoded once.
+		'''
+		if self._split is not None:
+			return self._split
+
+		insns = self.disassembly()
+		k = 0
+		offset = 0
+		while offset < self.parent_offset and k < len(insns):
+			offset += len(insns[k])
+			k += 1
+
+		mid = self.start + self.parent_offset
+		if offset == self.parent_offset:
+			suffix = InstSeq(
+				self.addr(),
+				self.buf,
+				self.dasm,
+				insns,
+				self.start,
+				mid,
+				0,
+				k
+			)
+			parent = InstSeq(
+				self.addr() + self.parent_offset,
+				self.buf,
+				self.dasm,
+				insns,
+				mid,
+				self.end,
+				k,
+				len(insns)
+			)
+		else:
+			#decoding the whole gadget doesnt land on the parent,
+			#so each side has to be decoded on its own
+			suffix = InstSeq(self.addr(), self.buf, self.dasm, None, self.start, mid)
+			parent = InstSeq(
+				self.addr() + self.parent_offset,
+				self.buf,
+				self.dasm,
+				None,
+				mid,
+				self.end
+			)
+
+		return self.memoize('_split', (suffix, parent))
 		
 	def suffix(self):
 		'''
@@ -245,19 +716,10 @@ class Gadget(InstSeq):
 		the gadget terminator (i.e. RET). by "prefix"
 		i mean the gadget terminator sequence. 
 		'''
-
-		return InstSeq(
-			self.addr(),
-			self.data[:self.parent_offset],
-			self.dasm
-		)
+		return self.split()[0]
 
 	def parent(self):
-		return InstSeq(
-			self.addr() + self.parent_offset,
-			self.data[self.parent_offset:],
-			self.dasm
-		)
+		return self.split()[1]
 
 	def prefix(self):
 		return self.parent()
@@ -15,6 +15,8 @@
 # along with sefi.  If not, see <http://www.gnu.org/licenses/>.
 import re
 import sys
+import binascii
+import collections
 
 from sefi.log import debug, info, warning
 from sefi.err import SefiErr
@@ -28,39 +30,109 @@ class ArchNotSupported(DisassemblerErr):
 class LibNotFound(DisassemblerErr):
 	pass
 
-class Instr(object):
+def window_bytes(data, start=0, length=None):
+	'''
+	returns @length bytes of @data from @start as a str. @data
+	can be a str, a bytearray, a memoryview or (for compatibility)
+	a tuple of integers. a str covering the whole window is returned
+	as is, without copying it.
+	'''
+	if length is None:
+		end = len(data)
+	else:
+		end = min(len(data), start + length)
+
+	if isinstance(data, str):
+		if start == 0 and end == len(data):
+			return data
+		return data[start:end]
+	elif isinstance(data, tuple):
+		return "".join([chr(x) for x in data[start:end]])
+	elif isinstance(data, memoryview):
+		return data[start:end].tobytes()
+	else:
+		return str(data[start:end])
+
+def text_id(text):
+	'''
+	returns the id of the instruction text @text, which is the
+	interned copy of @text. gadget searches decode the same few
+	hundred instructions millions of times, and this way they all
+	share one string, which hashes and compares by identity. python
+	frees an interned string once nothing refers to it, so the texts
+	which depend on the address (branch targets, immediates) dont
+	pile up over a search the way a table of every text would.
+	'''
+	return intern(text)
+
+#x86 decoders can merge a WAIT (9b) with the x87 instruction
+#after it if that instruction has a WAIT form, e.g. FNINIT (db e3)
+X86_CONTINUATION = "\xdb\xe3"
+
+#classification bits of an instruction, see Instr.flags
+NOP			= 1 << 0
+BAD			= 1 << 1
+RET			= 1 << 2
+JMP_REG		= 1 << 3
+CALL_REG	= 1 << 4
+COND		= 1 << 5
+UNCOND		= 1 << 6
+
+class_slots = {}
+
+def slot_names(cls):
+	'''the names of the __slots__ of @cls and its bases'''
+	names = class_slots.get(cls)
+	if names is None:
+		names = []
+		for c in cls.__mro__:
+			names.extend(c.__dict__.get('__slots__', ()))
+		class_slots[cls] = names
+
+	return names
 
-	def __init__(self, addr, data, dasm):
+class Instr(object):
+	'''
+	a decoded instruction. these are created for every offset
+	that gets disassembled, so they are slotted and keep only
+	the address, the bytes (a str), the disassembler, the id
+	of the instruction text and the classification bits, which
+	the backend either passes in as @flags or computes once in
+	classify. subclasses that need
+	more state must declare their own __slots__ and set it before
+	calling this constructor. instructions are not meant to be
+	modified after they are created.
+	'''
+
+	__slots__ = ('addr', 'data', 'dasm', 'text_id', 'flags')
+
+	def __init__(self, addr, data, dasm, text, flags=None):
 		self.addr = addr
+		if isinstance(data, tuple):
+			data = window_bytes(data)
+		if not isinstance(data, str):
+			raise TypeError("expected str for data")
 		self.data = data
-		if not isinstance(self.data, tuple):
-			raise TypeError("expected tuple for data")
 		self.dasm = dasm
-		self.frozen = True
-
-	def addr(self):
-		return self.addr
-
-	def data(self):
-		return self.data
-
-	def dasm(self):
-		return self.dasm
+		self.text_id = text_id(text)
+		if flags is None:
+			flags = self.classify()
+		self.flags = flags
 
 	def arch(self):
 		return self.dasm.arch()
 
-	def immutable_exception(self):
-		raise Exception("%s is meant to be immutable" % self.__class__.__name__)
-
-	def __setattr__(self, *args):
-		if getattr(self, 'frozen', False):
-			return self.immutable_exception()
-		else:
-			return super(Instr, self).__setattr__(*args)
-
-	def __delattr__(self, *ignored):
-		return self.immutable_exception()
+	def relocate(self, addr):
+		'''
+		returns a copy of this instruction at @addr. this is
+		only right for instructions whose decode doesnt depend
+		on their address (see DecodeCache).
+		'''
+		ins = object.__new__(self.__class__)
+		for name in slot_names(self.__class__):
+			setattr(ins, name, getattr(self, name))
+		ins.addr = addr
+		return ins
 
 	def __hash__(self):
 		return hash((
@@ -74,7 +146,7 @@ class Instr(object):
 		returns simple form of instruction suitable
 		for regexp matching
 		'''
-		raise Exception("not implemented")
+		return self.text_id
 
 	def display(self):
 		'''
@@ -85,7 +157,7 @@ class Instr(object):
 	def internal_display(self, addr_fmt, instr_str, comment):
 		return "%4s%-16s%2s%-23s%s%s" % (
 			"", addr_fmt % (self.addr),
-			"", "".join(map(lambda b: "%02x" % b, self.data)),
+			"", binascii.hexlify(self.data),
 			instr_str, comment
 		)
 
@@ -119,6 +191,15 @@ class Instr(object):
 		return (self.data == other.data) \
 				and (self.arch() == other.arch())
 
+	def classify(self):
+		'''
+		returns the classification bits (NOP, BAD, RET, ...)
+		of this instruction as a single int. this is called
+		once, when the instruction is created, and the
+		predicates below just test the bits.
+		'''
+		raise Exception("not implemented")
+
 	def match_regexp(self, *regexps):
 		for reg in regexps:
 			#print "match %r against %r" % (reg, ins)
@@ -131,50 +212,49 @@ class Instr(object):
 		'''
 		does this instruction do nothing??
 		'''
-		raise Exception("not implemented")
+		return (self.flags & NOP) != 0
 
 	def has_uncond_ctrl_flow(self):
 		'''
 		does this instruction have unconditional control
 		flow?
 		'''
-		raise Exception("not implemented")
+		return (self.flags & UNCOND) != 0
 
 	def has_cond_ctrl_flow(self):
 		'''
 		does this instruction have conditional control
 		flow?
 		'''
-		raise Exception("not implemented")
+		return (self.flags & COND) != 0
 
 	def has_ctrl_flow(self):
 		'''
 		does this instruction have any control
 		flow at all?
 		'''
-		return self.has_cond_ctrl_flow() or \
-				self.has_uncond_ctrl_flow()
+		return (self.flags & (COND | UNCOND)) != 0
 
 	def bad(self):
 		'''
 		is this instruction bad? does it mess up
 		program execution in some way?
 		'''
-		raise Exception("not implemented")
+		return (self.flags & BAD) != 0
 
 	def ret(self):
 		'''
 		does this instruction pop a value off the
 		stack and then jump to that address?
 		'''
-		raise Exception("not implemented")
+		return (self.flags & RET) != 0
 
 	def jmp_reg_uncond(self):
 		'''
 		does this instruction jump to a value
 		in a register (direct or indirect)?
 		'''
-		raise Exception("not implemented")
+		return (self.flags & JMP_REG) != 0
 
 	def call_reg(self):
 		'''
@@ -183,18 +263,271 @@ class Instr(object):
 		based on a value in a register (direct or 
 		indirect)?
 		'''		
-		raise Exception("not implemented")
+		return (self.flags & CALL_REG) != 0
+
+class DecodeCache(object):
+	'''
+	a cache of decoded instructions keyed by (disassembler, bytes of
+	the instruction), holding at most @size entries and evicting the
+	least recently used one when it is full. a cached instruction
+	is handed out relocated to the address it was asked for. the
+	backends dont agree on the text or the classification of an
+	instruction, so each disassembler only sees its own entries.
+
+	the length of an instruction isnt known before it is decoded,
+	so how many of the cached instructions starting with each byte
+	have each length is counted and only those keys are tried. the
+	counts go down as entries are evicted. instruction sets are
+	mostly prefix free, so at most one of the keys can match. the
+	exceptions are instructions which a decoder merges with the
+	instruction after them (distorm decodes 9b alone as WAIT but
+	9b db e3 as FINIT).
+
+	when an instruction is first decoded it is decoded again at a
+	different address, followed by the continuation of its
+	disassembler (see Disassembler.continuation). if that changes
+	its length (it was merged), its text or its classification
+	(relative branches, for example), the entry only records that
+	those bytes must always be decoded in place. bad instructions
+	are never cached, as the bytes after them can be the reason
+	they are bad.
+	'''
+
+	#how far away the second decode of a new instruction is done
+	RELOCATE_DELTA = 0x1000
+
+	def __init__(self, size=1 << 16):
+		self.size = size
+		self.entries = collections.OrderedDict()
+		self.lengths = {}
+		self.hits = 0
+		self.misses = 0
+
+	def __len__(self):
+		return len(self.entries)
+
+	def clear(self):
+		self.entries.clear()
+		self.lengths.clear()
+		self.hits = 0
+		self.misses = 0
+
+	@staticmethod
+	def decode_one(dasm, addr, data, start, length):
+		for ins in dasm.decode(addr, data, start, length):
+			return ins
+
+		return None
+
+	def lookup(self, dasm, addr, data, start, length):
+		'''
+		returns the cached instruction for the bytes at @start of
+		@data (no more than @length of them) relocated to @addr.
+		returns None if nothing is cached for those bytes and False
+		if they have to be decoded in place.
+		'''
+		if self.size < 1:
+			return None
+
+		for n in self.lengths.get((dasm, window_bytes(data, start, 1)), ()):
+			if n > length:
+				continue
+
+			key = (dasm, window_bytes(data, start, n))
+			ins = self.entries.pop(key, None)
+			if ins is None:
+				continue
+
+			self.entries[key] = ins
+			if ins is False:
+				return False
+
+			self.hits += 1
+			return ins.relocate(addr)
+
+		return None
+
+	def store(self, dasm, data, start, ins):
+		'''
+		remember @ins, which was decoded from @start of @data.
+		'''
+		if self.size < 1 or ins is None or ins.bad() or len(ins) < 1:
+			return
+
+		n = len(ins)
+		probe = window_bytes(data, start, n) + dasm.continuation
+		other = self.decode_one(dasm, ins.addr + self.RELOCATE_DELTA, probe, 0, len(probe))
+		if other is not None \
+				and len(other) == n \
+				and other.text_id == ins.text_id \
+				and other.flags == ins.flags:
+			entry = ins
+		else:
+			entry = False
+
+		key = (dasm, window_bytes(data, start, n))
+		if key in self.entries:
+			self.forget(key)
+		self.entries[key] = entry
+		counts = self.lengths.setdefault((dasm, key[1][:1]), {})
+		counts[n] = counts.get(n, 0) + 1
+		while len(self.entries) > self.size:
+			self.forget(next(iter(self.entries)))
+
+	def forget(self, key):
+		'''drop the entry for @key and its count in lengths'''
+		del self.entries[key]
+		(dasm, data) = key
+		first = (dasm, data[:1])
+		counts = self.lengths[first]
+		counts[len(data)] -= 1
+		if counts[len(data)] < 1:
+			del counts[len(data)]
+			if len(counts) < 1:
+				del self.lengths[first]
+
+	def first(self, dasm, addr, data, start, length):
+		'''
+		returns the first instruction obtained by decoding @length
+		bytes of @data from @start at address @addr, or None if
+		nothing could be decoded.
+		'''
+		cached = self.lookup(dasm, addr, data, start, length)
+		if cached is not None and cached is not False:
+			return cached
+
+		if self.size > 0:
+			self.misses += 1
+
+		ins = self.decode_one(dasm, addr, data, start, length)
+		if cached is None:
+			self.store(dasm, data, start, ins)
+
+		return ins
+
+#the cache used by sefi.container.DecodeTable unless it is given one
+decode_cache = DecodeCache()
+
+def decode_paths(dasm, data, base_addr, offsets, max_insns=1, run_len=32, max_len=16):
+	'''
+	an implementation of Disassembler.decode_at_offsets for
+	backends which decode variable length instructions. instead of
+	one call into the decoder per offset, it decodes a run of up
+	to @run_len bytes from the first offset it doesnt know yet, and
+	every instruction on that run answers the offset it starts at.
+	a run stops as soon as it lands on an offset that is already
+	known, as the rest of its path is known too, and after a bad
+	instruction, as decoders dont always resume after one the way
+	a decode starting right after it would. the last @max_len
+	bytes of a run which was cut short of the end of @data might
+	hold truncated instructions, so nothing starting there is kept.
+	'''
+	decoded = {}
+	size = len(data)
+
+	def at(pos):
+		if pos in decoded:
+			return decoded[pos]
+
+		end = min(size, pos + run_len)
+		p = pos
+		for ins in dasm.decode(base_addr+pos, data, pos, end-pos):
+			if p != pos and (p in decoded or (end < size and p + max_len > end)):
+				break
+			decoded[p] = ins
+			if len(ins) < 1 or ins.bad():
+				break
+			p += len(ins)
+
+		return decoded.setdefault(pos, None)
+
+	return dict((off, follow(at, off, size, max_insns)) for off in offsets)
+
+def follow(at, offset, size, max_insns):
+	'''
+	returns the (up to @max_insns) instructions decoded linearly
+	from @offset, getting each one from the function @at. the
+	instructions end with the first bad one.
+	'''
+	insns = []
+	while len(insns) < max_insns and offset < size:
+		ins = at(offset)
+		if ins is None or len(ins) < 1:
+			break
+		insns.append(ins)
+		if ins.bad():
+			break
+		offset += len(ins)
+
+	return insns
 
 class Disassembler(object):
 
-	def decode(self, addr, data):
+	#name of the backend this disassembler was loaded from
+	backend = None
+
+	#enough bytes to hold the longest instruction
+	max_insn_len = 16
+
+	#the Instr subclass rebuild creates
+	instr_class = None
+
+	#an instruction, as a str, which this disassembler merges with
+	#the instruction before it when that one can be merged at all.
+	#see DecodeCache
+	continuation = ""
+
+	def decode(self, addr, data, start=0, length=None):
+		'''
+		decode the @length bytes (or the rest) of the buffer @data
+		from offset @start, where the byte at @start is at address
+		@addr. yields Instr objects. see window_bytes for the
+		types @data can be.
+		'''
 		raise Exception("not implemented")
 
+	def decode_at_offsets(self, data, base_addr, offsets, max_insns=1):
+		'''
+		decodes up to @max_insns instructions linearly from each of
+		the @offsets into the buffer @data, which starts at address
+		@base_addr. returns a dict mapping each offset to the list
+		of instructions decoded from it, which ends with the first
+		bad instruction. backends override this to answer many
+		offsets with few calls into the decoder.
+		'''
+		result = {}
+		window = max_insns * self.max_insn_len
+		for off in offsets:
+			insns = []
+			for ins in self.decode(base_addr+off, data, off, window):
+				insns.append(ins)
+				if len(insns) >= max_insns or ins.bad():
+					break
+			result[off] = insns
+
+		return result
+
+	def rebuild(self, addr, data, text, flags):
+		'''
+		returns the instruction at @addr with the bytes @data which
+		was decoded (in another process) as @text with the
+		classification bits @flags, without decoding it again.
+		'''
+		return self.instr_class(addr, data, self, text, flags)
+
 	def arch(self):
 		raise Exception("not implemented")
 
 backends = {}
 rankings = {}
+
+#names of the backends whose library could not be imported
+failed = set()
+#disassemblers returned by try_backend, keyed by (name, arch)
+loaded = {}
+#disassemblers returned by find, keyed by (arch, rankings)
+found = {}
+
 def add_backend(name, rank):
 	def decr(try_fn):
 		global backends
@@ -219,36 +552,75 @@ def backend_names():
 	)
 
 def try_backend(name, arch):
+	'''
+	returns the disassembler for @arch from the backend @name,
+	or None if the backend doesnt support @arch or its library
+	cant be loaded. the library of a backend is only imported
+	the first time it is tried, and each disassembler is only
+	created once.
+	'''
 	if name not in backends:
 		raise ValueError("unknown backend: %r" % name)
 
+	if name in failed:
+		return None
+
+	key = (name, arch)
+	if key in loaded:
+		return loaded[key]
+
 	try_fn = backends[name]
 	try:
 		dasm = try_fn(arch)
-		return dasm
+		if dasm is not None:
+			#remember where this disassembler came from so
+			#that it can be recreated in another process
+			dasm.backend = name
 	except LibNotFound as e:
 		#sys.stderr.write("failed to load library: %r" % e)
+		failed.add(name)
 		return None
-	
-	return name
+
+	loaded[key] = dasm
+	return dasm
 
 def find(arch):
-	libs = []
+	'''
+	returns the disassembler for @arch from the highest ranked
+	backend that supports it. the answer is remembered until
+	the rankings change.
+	'''
+	key = (arch, tuple(sorted(rankings.items())))
+	if key in found:
+		return found[key]
 
 	for name in backend_names():
 		result = try_backend(name, arch)
-		if result is None:
-			continue
-		elif isinstance(result, str):
-			libs.append(result)
-		else:
+		if result is not None:
+			found[key] = result
 			return result
 
 	raise ArchNotSupported(
 		"could not find disassembler for %r in " % (arch) + \
-		"the following libraries: %s" % (libs)
+		"the following libraries: %s " % (
+			[n for n in backend_names() if n not in failed]
+		) + \
+		"(could not load: %s)" % (sorted(failed))
 	)
 
+def recreate(name, arch):
+	'''
+	returns the disassembler for @arch from the backend @name.
+	used to get an equivalent disassembler inside a worker process.
+	'''
+	dasm = try_backend(name, arch)
+	if dasm is None:
+		raise ArchNotSupported(
+			"backend %r could not be loaded for %r" % (name, arch)
+		)
+
+	return dasm
+
 def do_try(fn, arch):
 	try:
 		dasm = fn(arch)
@@ -261,6 +633,11 @@ def try_distorm(arch):
 	from sefi.disassembler import sefi_distorm
 	return do_try(sefi_distorm.new, arch)
 
+@add_backend("distorm-decompose", 9)
+def try_distorm_decompose(arch):
+	from sefi.disassembler import sefi_distorm
+	return do_try(sefi_distorm.new_decompose, arch)
+
 @add_backend("llvm", 5)
 def try_llvm(arch):	
 	from sefi.disassembler import sefi_llvm
@@ -15,6 +15,7 @@
 # along with sefi.  If not, see <http://www.gnu.org/licenses/>.
 from sefi.disassembler import *
 import sefi.arch
+import struct
 
 try:
 	import darm
@@ -22,6 +23,9 @@ except Exception as e:
 	raise LibNotFound("error loading darm: %r" % e)
 
 class DarmInstr(Instr):
+
+	__slots__ = ()
+
 	def display(self):
 		addr_fmt = "%08x"
 
@@ -29,32 +33,13 @@ class DarmInstr(Instr):
 
 class BadDarmInstr(DarmInstr):
 
-	def __init__(self, addr, data, dasm):
-		super(BadDarmInstr, self).__init__(addr, data, dasm)
-
-	def __str__(self):
-		return "(bad)"
-
-	def nop(self):
-		return False
-
-	def has_uncond_ctrl_flow(self):
-		return False
-
-	def has_cond_ctrl_flow(self):
-		return False
-
-	def bad(self):
-		return True
+	__slots__ = ()
 
-	def ret(self):
-		return False
-
-	def jmp_reg_uncond(self):
-		return False
+	def __init__(self, addr, data, dasm):
+		super(BadDarmInstr, self).__init__(addr, data, dasm, "(bad)")
 
-	def call_reg(self):
-		return False
+	def classify(self):
+		return BAD
 
 BRANCH_INSTS = set([
 	"B",
@@ -68,16 +53,38 @@ BRANCH_INSTS = set([
 
 class GoodDarmInstr(DarmInstr):
 
-	def __init__(self, addr, data, darminst, dasm):
+	__slots__ = ('darminst',)
+
+	def __init__(self, addr, data, darminst, dasm, text=None, flags=None):
 		self.darminst = darminst
-		super(GoodDarmInstr, self).__init__(addr, data, dasm)
-		
-	def __str__(self):
-		return str(self.darminst).strip() 
+		if text is None:
+			text = str(darminst).strip()
+		super(GoodDarmInstr, self).__init__(
+			addr, data, dasm, text, flags
+		)
 
-	def nop(self):
-		reg = '^nop'
-		return self.match_regexp(reg)
+	def classify(self):
+		flags = 0
+
+		if self.match_regexp('^nop'):
+			flags |= NOP
+
+		if self.is_ret():
+			flags |= RET
+
+		if self.is_ctrl_flow():
+			if self.is_unconditional():
+				flags |= UNCOND
+			else:
+				flags |= COND
+
+		if self.is_jmp_reg():
+			flags |= JMP_REG
+
+		if self.is_call_reg():
+			flags |= CALL_REG
+
+		return flags
 
 	def name(self):
 		return str(self.darminst.instr)
@@ -99,14 +106,14 @@ class GoodDarmInstr(DarmInstr):
 		return \
 			self.name() in BRANCH_INSTS \
 			or ((not self.is_call())
-				and (not self.ret())
+				and (not self.is_ret())
 				and self.explicitly_modifies_pc()
 			)
 
 	def is_ctrl_flow(self):
 		return self.is_call() \
 			or self.is_branch() \
-			or self.ret()
+			or self.is_ret()
 
 	def cond(self):
 		return str(self.darminst.cond)
@@ -114,17 +121,6 @@ class GoodDarmInstr(DarmInstr):
 	def is_unconditional(self):
 		return self.cond() == "AL"
 
-	def has_uncond_ctrl_flow(self):
-		return self.is_ctrl_flow() \
-			and self.is_unconditional()
-
-	def has_cond_ctrl_flow(self):
-		return self.is_ctrl_flow() \
-			and not self.is_unconditional()
-
-	def bad(self):
-		return False
-
 	def Rd(self):
 		return str(self.darminst.Rd)
 
@@ -146,7 +142,7 @@ class GoodDarmInstr(DarmInstr):
 	def pc_in_reglist(self):
 		return "PC" in self.reglist()
 
-	def ret(self):
+	def is_ret(self):
 		return self.is_unconditional() \
 			and self.explicitly_modifies_pc() \
 			and (
@@ -157,7 +153,7 @@ class GoodDarmInstr(DarmInstr):
 				)
 			)
 
-	def jmp_reg_uncond(self):
+	def is_jmp_reg(self):
 		return self.is_unconditional() \
 			and self.is_branch() \
 			and (
@@ -165,81 +161,110 @@ class GoodDarmInstr(DarmInstr):
 				or (not self.darminst.Rn is None)
 			)
 
-	def call_reg(self):
+	def is_call_reg(self):
 		return self.is_unconditional() \
 			and self.is_call() \
 			and (not self.darminst.Rm is None)
 	
 class DarmDasm(Disassembler):
 
+	instr_class = DarmInstr
+
+	#number of distinct words remembered by decode_word
+	word_cache_size = 1 << 16
+
 	def __init__(self, dasm_fn, inst_size, arch):
 		self.dasm_fn = dasm_fn
-		self.arch
+		self.arch_name = arch
 		self.inst_size = inst_size
+		self.max_insn_len = inst_size
+		self.word_fmt = "I" if inst_size == 4 else "H"
+		self.words = {}
+
+	def decode_word(self, word):
+		'''
+		returns (darminst, text, flags) for the instruction encoded
+		by the integer @word, or None if darm cant decode it. ARM code
+		uses the same words over and over (e.g. pop {r4, pc}), so
+		the results are remembered and each distinct word is only
+		decoded and classified once.
+		'''
+		if word in self.words:
+			return self.words[word]
+
+		darm_inst = self.dasm_fn(word)
+		if darm_inst is None:
+			result = None
+		else:
+			ins = GoodDarmInstr(0, "", darm_inst, self)
+			result = (darm_inst, str(ins), ins.flags)
+
+		if len(self.words) >= self.word_cache_size:
+			self.words.clear()
+		self.words[word] = result
+		return result
 
-	class ChunkItr(object):
-		
-		def __init__(self, n, addr, data):
-			if not isinstance(data, tuple):
-				raise TypeError("expected tuple of integers for data, got %s" % type(data))
-			if n < 2:
-				raise ValueError("expected n > 2, got %d" % n)
-			if len(data) < 1:
-				raise ValueError("expected non empty data")
-			
-			self.n = n
-			self.addr = addr
-			self.data = data
-			self.remainder = None
-
-		def chunks(self):
-			curr_addr = self.addr
-			accum = []
-			self.remainder = None
-
-			for b in self.data:
-				accum.append(b)
-				if len(accum) == self.n:
-					yield (curr_addr, tuple(accum))
-					accum = []
-					curr_addr += self.n
-	
-			if len(accum) > 0:
-				self.remainder = (curr_addr, tuple(accum))
-
-	def chunk_to_int(self, chunk):
-		i = 0
-		result = 0
-		for b in chunk:
-			result |= b << (8*i)
-			i += 1
+	def make_instr(self, addr, chunk, word):
+		decoded = self.decode_word(word)
+		if decoded is None:
+			return BadDarmInstr(addr, chunk, self)
+
+		(darm_inst, text, flags) = decoded
+		return GoodDarmInstr(addr, chunk, darm_inst, self, text, flags)
+
+	def decode(self, addr, data, start=0, length=None):
+		'''
+		all the whole words of the window are unpacked with
+		one call to struct.unpack_from.
+		'''
+		data = window_bytes(data, start, length)
+		count = len(data) // self.inst_size
+		words = struct.unpack_from("<%d%s" % (count, self.word_fmt), data)
+
+		p = 0
+		for word in words:
+			yield self.make_instr(addr+p, data[p:p+self.inst_size], word)
+			p += self.inst_size
+
+		#an incomplete instruction is left over
+		if p < len(data):
+			yield BadDarmInstr(addr+p, data[p:], self)
+
+	def decode_at_offsets(self, data, base_addr, offsets, max_insns=1):
+		'''
+		instructions are all the same size, so each one is
+		unpacked straight out of @data with struct instead of
+		copying a window of it.
+		'''
+		fmt = "<" + self.word_fmt
+		size = len(data)
+		result = {}
+		for off in offsets:
+			insns = []
+			p = off
+			while len(insns) < max_insns and p < size:
+				if p + self.inst_size > size:
+					#an incomplete instruction is left over
+					insns.append(BadDarmInstr(
+						base_addr + p,
+						window_bytes(data, p, size - p),
+						self
+					))
+					break
+
+				insns.append(self.make_instr(
+					base_addr + p,
+					window_bytes(data, p, self.inst_size),
+					struct.unpack_from(fmt, data, p)[0]
+				))
+				p += self.inst_size
+
+			result[off] = insns
 
 		return result
-				
-	def decode(self, addr, data):
-		if len(data) < 1:
-			return
-		
-		itr = self.__class__.ChunkItr(self.inst_size, addr, data)
-		for (addr, chunk) in itr.chunks():
-			n = self.chunk_to_int(chunk)
-			#print("converted %r to 0x%08x" % (chunk, n))
-			darm_inst = self.dasm_fn(n)
-			if darm_inst is None:
-				yield BadDarmInstr(addr, chunk, self)
-			else:
-				yield GoodDarmInstr(addr, chunk, darm_inst, self)
-
-		#an incomplete instruction is left over		
-		if not itr.remainder is None:
-			yield BadDarmInstr(
-				itr.remainder[0],
-				itr.remainder[1],
-				self
-			)
 
 	def arch(self):
-		return self.arch
+		return self.arch_name
 		
 
 def new(arch):
@@ -51,15 +51,54 @@ CALL_REG_ALL = "^CALL .*(%s).*" % (
 
 NOP_ALL = '(?:NOP(?: |$))|(?:^MOV (.+),\s*(\\1)\s*)'
 
+#the other instructions distorm reports as conditional branches
+#(FC_CND_BRANCH, see classify_decomposed)
+COND_NAMES = ['JCXZ', 'JRCXZ', 'LOOP', 'LOOPZ', 'LOOPNZ']
+
+UNCOND_ALL = '^(?:CALL|JMP) '
+COND_ALL = '^(?:%s) ' % (
+	"|".join(filter(lambda str: str != 'JMP', JMP_NAMES) + COND_NAMES)
+)
+BAD_ALL = '^(?:DB |OUTS |IN |INS |HLT$)'
+
+CLASSES = [(re.compile(reg, re.IGNORECASE), bit) for (reg, bit) in [
+	(NOP_ALL, NOP),
+	(BAD_ALL, BAD),
+	(RET_ALL, RET),
+	(JMP_REG_UNCOND, JMP_REG),
+	(CALL_REG_ALL, CALL_REG),
+	(COND_ALL, COND),
+	(UNCOND_ALL, UNCOND)
+]]
+
+#the classification bits of the instruction texts seen
+#recently, keyed by text id. the texts of distorm hold branch
+#targets and immediates, so the table is cleared when it holds
+#text_flags_size of them.
+text_flags = {}
+text_flags_size = 1 << 16
+
+def classify_text(text):
+	flags = 0
+	for (reg, bit) in CLASSES:
+		if reg.search(text) is not None:
+			flags |= bit
+
+	return flags
+
 class DistormInstr(Instr):
 
-	def __init__(self, addr, data, dasm, display):
-		#Instr __init__ freezes this object, so must init display_str before call to super
-		self.display_str = display
-		super(DistormInstr, self).__init__(addr, data, dasm)
+	__slots__ = ()
 
-	def __str__(self):
-		return self.display_str
+	def classify(self):
+		flags = text_flags.get(self.text_id)
+		if flags is None:
+			flags = classify_text(str(self))
+			if len(text_flags) >= text_flags_size:
+				text_flags.clear()
+			text_flags[self.text_id] = flags
+
+		return flags
 
 	def display(self):
 		if self.dasm.arch == sefi.arch.x86_64:
@@ -70,7 +109,7 @@ class DistormInstr(Instr):
 		#[RIP+0x201ac2]
 		m = re.search(
 			"\[\s*(?:EIP|RIP)\s*\+\s*0x([0-9a-zA-Z]+)\s*\]",
-			self.display_str,
+			str(self),
 			re.IGNORECASE
 		)
 		if m is not None:
@@ -78,59 +117,74 @@ class DistormInstr(Instr):
 		else:
 			comment = ""
 
-		return self.internal_display(addr_fmt, self.display_str, comment)
+		return self.internal_display(addr_fmt, str(self), comment)
 
-	def nop(self):
-		return self.match_regexp(NOP_ALL)
+BAD_MNEMONICS = set(['OUTS', 'IN', 'INS', 'HLT'])
+RET_MNEMONICS = set(['RET', 'RETF'])
 
-	def has_uncond_ctrl_flow(self):
-		regs = [
-			'^CALL ',
-			'^JMP '
-		]
-		
-		return self.match_regexp(*regs)
+#operands which name a register, either directly or
+#in the expression of a memory address
+REG_OPERANDS = set([distorm3.OPERAND_REGISTER, distorm3.OPERAND_MEMORY])
 
-	def has_cond_ctrl_flow(self):
+def classify_decomposed(inst):
+	'''
+	the classification bits of the distorm3.Instruction @inst,
+	worked out from its flow control, mnemonic and operands
+	instead of its text.
+	'''
+	if not inst.valid:
+		return BAD
 
-		return self.match_regexp(*map( 
-			lambda j: '^%s ' % j,
-			filter(lambda str: str != 'JMP', JMP_NAMES)
-		))
+	flags = 0
+	mnemonic = inst.mnemonic
+	ops = inst.operands
+	fc = inst.flowControl
 
-	def bad(self):
-		regs = [
-			'^DB ',
-			'^OUTS ',
-			'^IN ',
-			'^INS ',
-			'^HLT$'
-		]
-	
-		return self.match_regexp(*regs)
+	if mnemonic == 'NOP' \
+			or (mnemonic == 'MOV'
+				and len(ops) == 2
+				and ops[0].type == distorm3.OPERAND_REGISTER
+				and ops[1].type == distorm3.OPERAND_REGISTER
+				and ops[0].index == ops[1].index):
+		flags |= NOP
 
-	def ret(self):
-		return self.match_regexp(RET_ALL)
+	if mnemonic in BAD_MNEMONICS:
+		flags |= BAD
 
-	def jmp_reg_uncond(self):
-		return self.match_regexp(JMP_REG_UNCOND)
+	if fc == 'FC_RET' and mnemonic in RET_MNEMONICS:
+		flags |= RET
+	elif fc == 'FC_CND_BRANCH':
+		flags |= COND
+	elif fc == 'FC_UNC_BRANCH' or fc == 'FC_CALL':
+		flags |= UNCOND
+		if len(ops) > 0 and ops[0].type in REG_OPERANDS:
+			if fc == 'FC_CALL':
+				flags |= CALL_REG
+			else:
+				flags |= JMP_REG
 
-	def call_reg(self):
-		return self.match_regexp(CALL_REG_ALL)
+	return flags
 
 class DistormDasm(Disassembler):
 
+	max_insn_len = 15
+	instr_class = DistormInstr
+	continuation = X86_CONTINUATION
+
 	def __init__(self, decode_size):
 		self.decode_size = decode_size
 		
-	def decode(self, addr, data):
-		if not isinstance(data, tuple):
-			raise TypeError("expected tuple of integers for data, got %s" % type(data))
-
-		str_data = "".join([chr(x) for x in data])
+	def decode(self, addr, data, start=0, length=None):
+		str_data = window_bytes(data, start, length)
 		for ds_inst in distorm3.Decode(addr, str_data, self.decode_size):
 			yield self.make_instr(ds_inst)
 
+	def decode_at_offsets(self, data, base_addr, offsets, max_insns=1):
+		return decode_paths(
+			self, data, base_addr, offsets, max_insns,
+			max_len=self.max_insn_len
+		)
+
 	def arch(self):
 		if self.decode_size == distorm3.Decode32Bits:
 			return sefi.arch.x86
@@ -141,13 +195,60 @@ class DistormDasm(Disassembler):
 	def make_instr(self, ds_inst):
 		return DistormInstr(
 			ds_inst[0],
-			tuple([ord(x) for x in ds_inst[3].decode('hex')]),
+			ds_inst[3].decode('hex'),
 			self,
 			ds_inst[2]
 		)
 
 
-def new(arch):
+#the slot of Instr holding the text id, which DecomposedInstr
+#hides behind a property
+text_slot = Instr.text_id
+
+class DecomposedInstr(DistormInstr):
+	'''
+	an instruction decoded by DecomposeDasm. the text of a
+	distorm3.Instruction is made by decoding it again with
+	distorm3.Decode, so the instruction is kept and its text is
+	only made the first time it is asked for.
+	'''
+
+	__slots__ = ('inst',)
+
+	def __init__(self, inst, dasm, flags):
+		self.inst = inst
+		self.addr = inst.address
+		self.data = inst.instructionBytes
+		self.dasm = dasm
+		self.flags = flags
+
+	def get_text_id(self):
+		try:
+			return text_slot.__get__(self, Instr)
+		except AttributeError:
+			tid = text_id(str(self.inst))
+			text_slot.__set__(self, tid)
+			return tid
+
+	def set_text_id(self, tid):
+		text_slot.__set__(self, tid)
+
+	text_id = property(get_text_id, set_text_id)
+
+class DecomposeDasm(DistormDasm):
+	'''
+	decodes with distorm3.DecomposeGenerator, which reports the
+	flow control, mnemonic and operands of each instruction, and
+	classifies the instructions from those. the text of an
+	instruction is only made when it is needed.
+	'''
+
+	def decode(self, addr, data, start=0, length=None):
+		str_data = window_bytes(data, start, length)
+		for inst in distorm3.DecomposeGenerator(addr, str_data, self.decode_size):
+			yield DecomposedInstr(inst, self, classify_decomposed(inst))
+
+def decode_size(arch):
 	if arch == sefi.arch.x86:
 		decode_size = distorm3.Decode32Bits
 	elif arch == sefi.arch.x86_64:
@@ -158,4 +259,10 @@ def new(arch):
 			sefi.arch.x86_64
 		))
 
-	return DistormDasm(decode_size)
+	return decode_size
+
+def new(arch):
+	return DistormDasm(decode_size(arch))
+
+def new_decompose(arch):
+	return DecomposeDasm(decode_size(arch))
@@ -15,6 +15,7 @@
 # along with sefi.  If not, see <http://www.gnu.org/licenses/>.
 from sefi.disassembler import *
 import sefi.arch
+import re
 
 try:
 	import llvm
@@ -28,6 +29,9 @@ from llvm.target import TargetMachine
 llvm.target.initialize_all()
 
 class LLVMInstr(Instr):
+
+	__slots__ = ()
+
 	def display(self):
 		if self.dasm.arch() == sefi.arch.x86_64:
 			addr_fmt = "%016x"
@@ -38,97 +42,109 @@ class LLVMInstr(Instr):
 
 class BadLLVMInstr(LLVMInstr):
 
+	__slots__ = ()
+
 	def __init__(self, addr, data, dasm):
-		super(BadLLVMInstr, self).__init__(addr, data, dasm)
+		super(BadLLVMInstr, self).__init__(addr, data, dasm, "(bad)")
 
-	def __str__(self):
-		return "(bad)"
+	def classify(self):
+		return BAD
 
-	def nop(self):
-		return False
+	
+#i cant seem to find a way to get llvm to report
+#whether an instruction is a nop. this will probably
+#miss more nops than i would like, but i cant think
+#of anything to improve it. ultimately, mistaking a
+#nop for a real instruction isnt that destructive to
+#finding gadgets, so its ok.
+NOP_RE = re.compile('noo?p(?: |$)', re.IGNORECASE)
 
-	def has_uncond_ctrl_flow(self):
-		return False
+#the flags of an instruction only depend on its opcode, except
+#for whether a call goes through a register. opcode_flags maps
+#(arch, opcode) to those flags and call_opcodes holds the keys
+#of the calls, so llvm is only asked about each opcode once.
+opcode_flags = {}
+call_opcodes = set()
 
-	def has_cond_ctrl_flow(self):
-		return False
+def classify_opcode(inst, text):
+	'''
+	returns the flags of the llvm instruction @inst, which is
+	printed as @text, that dont depend on its operands.
+	'''
+	flags = 0
 
-	def bad(self):
-		return True
+	if NOP_RE.search(text) is not None:
+		flags |= NOP
 
-	def ret(self):
-		return False
+	if inst.is_return():
+		flags |= RET
 
-	def jmp_reg_uncond(self):
-		return False
+	if inst.is_uncond_branch() or inst.is_return() or inst.is_call():
+		flags |= UNCOND
 
-	def call_reg(self):
-		return False
+	if inst.is_cond_branch():
+		flags |= COND
 
-	
-class GoodLLVMInstr(LLVMInstr):
+	if inst.is_uncond_branch() and inst.is_indirect_branch():
+		flags |= JMP_REG
 
-	def __init__(self, addr, data, llvminst, dasm):
-		self.llvminst = llvminst
-		super(GoodLLVMInstr, self).__init__(addr, data, dasm)
-		
-	def __str__(self):
-		return str(self.llvminst).strip()
+	return flags
 
-	def nop(self):
-		'''
-		i cant seem to find a way to get llvm to report
-		whether an instruction is a nop. this will probably
-		miss more nops than i would like, but i cant think
-		of anything to improve it. ultimately, mistaking a
-		nop for a real instruction isnt that destructive to
-		finding gadgets, so its ok.
-		'''
+class GoodLLVMInstr(LLVMInstr):
 
-		reg = 'noo?p(?: |$)'
-		return self.match_regexp(reg)
+	__slots__ = ('llvminst',)
 
-	def has_uncond_ctrl_flow(self):
-		return self.llvminst.is_uncond_branch() \
-					or self.ret() \
-					or self.llvminst.is_call()
+	def __init__(self, addr, data, llvminst, dasm):
+		self.llvminst = llvminst
+		super(GoodLLVMInstr, self).__init__(
+			addr, data, dasm, str(llvminst).strip()
+		)
 
-	def has_cond_ctrl_flow(self):
-		return self.llvminst.is_cond_branch()
+	def classify(self):
+		inst = self.llvminst
 
-	def bad(self):
-		return isinstance(self.llvminst, llvm.mc.BadInstr)
+		if isinstance(inst, llvm.mc.BadInstr):
+			flags = BAD | classify_opcode(inst, str(self))
+			if inst.is_call() and inst.operands()[0].is_reg():
+				flags |= CALL_REG
+			return flags
 
-	def ret(self):
-		return self.llvminst.is_return()
+		key = (self.dasm.arch(), inst.opcode)
+		flags = opcode_flags.get(key)
+		if flags is None:
+			flags = classify_opcode(inst, str(self))
+			opcode_flags[key] = flags
+			if inst.is_call():
+				call_opcodes.add(key)
 
-	def jmp_reg_uncond(self):
-		return self.llvminst.is_uncond_branch() \
-					and self.llvminst.is_indirect_branch()
+		if key in call_opcodes and inst.operands()[0].is_reg():
+			flags |= CALL_REG
 
-	def call_reg(self):
-		return self.llvminst.is_call() \
-				and self.llvminst.operands()[0].is_reg()
+		return flags
 
 class LLVMDasm(Disassembler):
 
+	instr_class = LLVMInstr
+
 	def __init__(self, llvmdasm, arch):
 		self.llvmdasm = llvmdasm
-		self.arch
+		self.arch_name = arch
+		if arch in (sefi.arch.x86, sefi.arch.x86_64):
+			self.continuation = X86_CONTINUATION
 		
-	def decode(self, addr, data):
-		if not isinstance(data, tuple):
-			raise TypeError("expected tuple of integers for data, got %s" % type(data))
-
-		str_data = "".join([chr(x) for x in data])
+	def decode(self, addr, data, start=0, length=None):
+		str_data = window_bytes(data, start, length)
 		for (addr, data, llvminst) in self.llvmdasm.decode(str_data, addr):
 			if llvminst is None:
 				yield BadLLVMInstr(addr, data, self)
 			else:
 				yield GoodLLVMInstr(addr, data, llvminst, self)
+
+	def decode_at_offsets(self, data, base_addr, offsets, max_insns=1):
+		return decode_paths(self, data, base_addr, offsets, max_insns)
 				
 	def arch(self):
-		return self.arch
+		return self.arch_name
 		
 
 def new(arch):
@@ -13,10 +13,100 @@
 #  
 # You should have received a copy of the GNU General Public License
 # along with sefi.  If not, see <http://www.gnu.org/licenses/>.
-
+import re
+
+import sefi.arch
+
+def byte_class(pred):
+	'''
+	returns a regexp character class matching every byte
+	value for which @pred is true.
+	'''
+	return "[%s]" % "".join([
+		re.escape(chr(b)) for b in range(0, 256) if pred(b)
+	])
+
+def word_signature(mask, value, size=4):
+	'''
+	returns a regexp matching a little endian word of @size
+	bytes for which (word & @mask) == @value.
+	'''
+	result = ""
+	for i in range(0, size):
+		m = (mask >> (8*i)) & 0xff
+		v = (value >> (8*i)) & 0xff
+		result += byte_class(lambda b: (b & m) == v)
+
+	return result
+
+def x86_signature(prefixes, opcode):
+	'''
+	returns a regexp matching @opcode preceded by up to 14
+	bytes from the character class @prefixes.
+	'''
+	return "%s{0,14}%s" % (prefixes, opcode)
+
+X86_PREFIXES = byte_class(
+	lambda b: b in (0x26, 0x2e, 0x36, 0x3e, 0x64, 0x65, 0x66, 0x67, 0xf0, 0xf2, 0xf3)
+)
+#in 64 bit mode 0x40-0x4f are REX prefixes
+X86_64_PREFIXES = byte_class(
+	lambda b: b in (0x26, 0x2e, 0x36, 0x3e, 0x64, 0x65, 0x66, 0x67, 0xf0, 0xf2, 0xf3) \
+		or (b & 0xf0) == 0x40
+)
+
+#RET, RET imm16, RETF, RETF imm16, IRET
+X86_RET = byte_class(lambda b: b in (0xc2, 0xc3, 0xca, 0xcb, 0xcf))
+#FF /4 (JMP r/m) and FF /5 (JMP FAR m)
+X86_JMP_REG = "\\xff" + byte_class(lambda b: (b & 0x38) in (0x20, 0x28))
+#FF /2 (CALL r/m) and FF /3 (CALL FAR m)
+X86_CALL_REG = "\\xff" + byte_class(lambda b: (b & 0x38) in (0x10, 0x18))
+
+#ARM words with condition AL, as (mask, value) pairs:
+#POP/LDM with pc in the register list
+ARM_LDM_PC_WORD = (0xfe108000, 0xe8108000)
+#POP {pc}/LDR pc, [...]
+ARM_LDR_PC_WORD = (0xfc50f000, 0xe410f000)
+#any instruction with pc as its destination register
+ARM_RD_PC_WORD = (0xf000f000, 0xe000f000)
+ARM_BX_WORD = (0xfffffff0, 0xe12fff10)
+ARM_BXJ_WORD = (0xfffffff0, 0xe12fff20)
+ARM_BLX_REG_WORD = (0xfffffff0, 0xe12fff30)
+
+ARM_LDM_PC = word_signature(*ARM_LDM_PC_WORD)
+ARM_LDR_PC = word_signature(*ARM_LDR_PC_WORD)
+ARM_RD_PC = word_signature(*ARM_RD_PC_WORD)
+ARM_BX = word_signature(*ARM_BX_WORD)
+ARM_BXJ = word_signature(*ARM_BXJ_WORD)
+ARM_BLX_REG = word_signature(*ARM_BLX_REG_WORD)
+
+#the backends whose idea of a terminator the signatures of an
+#architecture were written for. other backends classify more
+#instructions as terminators (llvm counts "bx lr" and conditional
+#returns as returns on arm), so no offsets can be skipped for them.
+#the signatures of an architecture which isnt listed here hold
+#for every backend.
+SIGNATURE_BACKENDS = {
+	sefi.arch.arm:		set(["darm"])
+}
+
+def signature_holds(arch, backend):
+	'''
+	can the signatures for @arch be used to skip offsets when
+	decoding with the disassembler backend named @backend?
+	'''
+	if arch not in SIGNATURE_BACKENDS:
+		return True
+
+	return backend in SIGNATURE_BACKENDS[arch]
 
 class Matcher(object):
 
+	#byte signatures keyed by architecture. see signature()
+	signatures = {}
+	#instruction word patterns keyed by architecture. see words()
+	word_patterns = {}
+
 	def __init__(self, uncond_flow=True, cond_flow=True):
 		self.uncond_flow = uncond_flow
 		self.cond_flow = cond_flow
@@ -27,38 +117,113 @@ class Matcher(object):
 	def match(self, inst_seq):
 		raise Exception("not implemented")
 
+	def name(self):
+		'''a short name for this matcher, used when reporting gadgets'''
+		return self.__class__.__name__.lower()
+
 	def allow_uncond_flow(self):
 		return self.uncond_flow
 
 	def allow_cond_flow(self):
 		return self.cond_flow
 
+	def signature(self, arch, backend=None):
+		'''
+		returns a regexp over the raw bytes of a segment which
+		matches at (at least) every offset where this matcher could
+		match an instruction decoded by @backend for @arch, or None
+		if this matcher has no such signature and every offset has
+		to be disassembled.
+		'''
+		if not signature_holds(arch, backend):
+			return None
+
+		return self.signatures.get(arch)
+
+	def words(self, arch, backend=None):
+		'''
+		returns a list of (mask, value) pairs such that this matcher
+		can only match a 32 bit little endian instruction word decoded
+		by @backend for which (word & mask) == value for one of the
+		pairs, or None if @arch doesnt have fixed width instructions
+		or this matcher cant be described that way.
+		'''
+		if not signature_holds(arch, backend):
+			return None
+
+		return self.word_patterns.get(arch)
+
 class REMatcher(Matcher):
 	def __init__(self, reg):
 		super(REMatcher, self).__init__()
 		self.reg = reg
 
+	def name(self):
+		return "regexp:%s" % self.reg
+
 	def match(self, inst_seq):
 		return inst_seq[0].match_regexp(self.reg)
 
 class Rets(Matcher):
+
+	signatures = {
+		sefi.arch.x86:		x86_signature(X86_PREFIXES, X86_RET),
+		sefi.arch.x86_64:	x86_signature(X86_64_PREFIXES, X86_RET),
+		sefi.arch.arm:		"|".join([ARM_LDM_PC, ARM_LDR_PC])
+	}
+
+	word_patterns = {
+		sefi.arch.arm:		[ARM_LDM_PC_WORD, ARM_LDR_PC_WORD]
+	}
+
 	def __init__(self):
 		super(Rets, self).__init__()
 
+	def name(self):
+		return "ret"
+
 	def match(self, inst_seq):
 		return inst_seq[0].ret()
 
 class JmpRegUncond(Matcher):
+
+	signatures = {
+		sefi.arch.x86:		x86_signature(X86_PREFIXES, X86_JMP_REG),
+		sefi.arch.x86_64:	x86_signature(X86_64_PREFIXES, X86_JMP_REG),
+		sefi.arch.arm:		"|".join([ARM_BX, ARM_BXJ, ARM_RD_PC, ARM_LDM_PC])
+	}
+
+	word_patterns = {
+		sefi.arch.arm:		[ARM_BX_WORD, ARM_BXJ_WORD, ARM_RD_PC_WORD, ARM_LDM_PC_WORD]
+	}
+
 	def __init__(self):
 		super(JmpRegUncond, self).__init__()
 
+	def name(self):
+		return "jmp-reg"
+
 	def match(self, inst_seq):
 		return inst_seq[0].jmp_reg_uncond()
 
 class CallReg(Matcher):
+
+	signatures = {
+		sefi.arch.x86:		x86_signature(X86_PREFIXES, X86_CALL_REG),
+		sefi.arch.x86_64:	x86_signature(X86_64_PREFIXES, X86_CALL_REG),
+		sefi.arch.arm:		ARM_BLX_REG
+	}
+
+	word_patterns = {
+		sefi.arch.arm:		[ARM_BLX_REG_WORD]
+	}
+
 	def __init__(self):
 		super(CallReg, self).__init__()
 
+	def name(self):
+		return "call-reg"
+
 	def match(self, inst_seq):
 		return inst_seq[0].call_reg()
 